@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Rebuild a feed (or retranslate a day of stories) from captured UCDP messages.
+#
+#    ./backfill.py --docroot DIR --feed NAME [--workers N] [--rate R] ... CAPTURE ...
+#
+# Each CAPTURE is a capture log segment, a raw dump of the stream, or a directory of
+# either.  The messages go through the same XinhuaTranslatorRSS as the live stream
+# (dispatch, pipeline, translation, feeds), just without UCDP, so the pages and the feed
+# come out the same.  Translations already in the translation cache are not paid for
+# again, and repeats within the capture are dropped; the dedup index of the live
+# ingester is not used, or every story it has already seen would be dropped.  The
+# docroot and feed have no defaults: a backfill into the live ingester's feed would
+# have the two of them rewriting it over each other.  The RSS_OUTPUTS feeds go into the
+# same docroot.
+#
+# Progress is printed every --progress seconds.  Every --checkpoint seconds the feeds
+# are flushed and the number of messages whose pages and feed entries are on disk is
+# saved, along with how far each feed has got, and a rerun with the same captures
+# carries on from there without adding a story to a feed twice (--restart to start
+# over).  Ctrl-C stops cleanly with a checkpoint.
+
+import os
+import sys
+import json
+import signal
+import time
+import argparse
+import threading
+from collections import deque
+
+import ga_translate
+from ga_translate import UCDPFramer, CaptureReader, METRICS
+
+
+def capture_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [ os.path.join(path, f) for f in sorted(os.listdir(path)) ]
+        else:
+            files.append(path)
+    return [ os.path.abspath(f) for f in files ]
+
+
+def captured_messages(files):
+    for fname in files:
+        if fname.endswith(".gacap"):
+            for when, msg in CaptureReader([ fname ]).messages():
+                yield msg
+        else:
+            with open(fname, "rb") as f:
+                for msg in UCDPFramer().feed(f.read()):
+                    yield msg
+
+
+########################################################################################
+# Checkpoint: how many messages of the capture are safely published
+#    Stories are committed in order, but a story is only safe once its pages are on
+#    disk and their feed entries have been flushed.  Page writes complete in
+#    submission order, so the committed messages are tracked in a queue with the
+#    feeds each still waits for, and everything at the head of the queue with none
+#    left is done.  A flush can catch a story in some feeds but not yet in others, so
+#    each feed's own count is saved too and a resumed run leaves that feed out for
+#    the messages it already has.
+########################################################################################
+class Checkpoint:
+    def __init__(self, path, files, total):
+        self._path = path
+        self._files = files
+        self._total = total
+        self._lock = threading.Lock()
+        self._pending = deque()     # [message number, feeds whose page is not yet written]
+        self._fed = {}              # feed path -> messages whose entries are in that feed
+        self.done = 0
+        self.committed = 0
+
+    def load(self):
+        # messages already done by an earlier run, or None if it was a different capture
+        try:
+            with open(self._path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if (state.get("files") != self._files or state.get("total") != self._total):
+            return None
+        self._fed = state.get("feeds", {})
+        return state.get("done", 0)
+
+    def start_at(self, n):
+        self.done = n
+        self.committed = n
+
+    def committed_story(self, story, outputs):
+        # on_commit: the next message goes to outputs; returns those that do not have it yet
+        with self._lock:
+            n = self.committed
+            outputs = [ output for output in outputs if self._fed.get(output.feed_path(), 0) <= n ]
+            self._pending.append([ n, [ output.feed_path() for output in outputs ] ])
+            self.committed += 1
+            self._advance()
+            return outputs
+
+    def page_written(self, output, fname):
+        # on_page_written: the page is on disk and its entry is in the feed
+        key = output.feed_path()
+        with self._lock:
+            for entry in self._pending:
+                if (key in entry[1]):
+                    entry[1].remove(key)
+                    self._fed[key] = entry[0] + 1
+                    break
+            self._advance()
+
+    def _advance(self):
+        while (len(self._pending) > 0 and len(self._pending[0][1]) == 0):
+            self.done = self._pending.popleft()[0] + 1
+
+    def save(self, rss = None):
+        # rss's feeds are flushed first; no feed entry can be added until the counts
+        # that go with them are saved
+        if (rss != None):
+            rss.flush(self._save)
+        else:
+            self._save()
+        return self.done
+
+    def _save(self):
+        with self._lock:
+            tmp = self._path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({ 'files' : self._files, 'total' : self._total, 'done' : self.done,
+                            'feeds' : self._fed }, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._path)
+
+
+def report(checkpoint, total, start, first):
+    counters = METRICS.snapshot()[0]
+    elapsed = time.time() - start
+    rate = (checkpoint.committed - first) / elapsed if elapsed > 0 else 0
+    eta = (total - checkpoint.committed) / rate if rate > 0 else float("nan")
+    print("%d/%d messages, %d safe, %.1f msg/s, %d translate calls, %d cache hits, %d duplicates, eta %.0f s" %
+          (checkpoint.committed, total, checkpoint.done, rate, counters.get("translate_cache_misses", 0),
+           counters.get("translate_cache_hits", 0), counters.get("duplicates", 0), eta))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Translate and publish captured UCDP messages in one batch")
+    parser.add_argument("--docroot", required = True, help = "where the pages and feed go, not the live ingester's")
+    parser.add_argument("--urlroot", default = ga_translate.URLROOT)
+    parser.add_argument("--feed", required = True, help = "feed file name under the docroot")
+    parser.add_argument("--title", default = ga_translate.RSSTITLE)
+    parser.add_argument("--description", default = ga_translate.RSSDESCRIPTION)
+    parser.add_argument("--maxitems", type = int, default = 100)
+    parser.add_argument("--workers", type = int, default = 16, help = "stories translated at once")
+    parser.add_argument("--backend", default = ga_translate.TRANSLATE_BACKEND, help = "amazon, google or stub")
+    parser.add_argument("--rate", type = float, default = ga_translate.TRANSLATE_RATE, help = "translate requests per second, 0 for no limit")
+    parser.add_argument("--char-rate", type = float, default = ga_translate.TRANSLATE_CHAR_RATE, help = "translated characters per second, 0 for no limit")
+    parser.add_argument("--concurrency", type = int, default = ga_translate.TRANSLATE_MAX_CONCURRENCY, help = "most translate calls in flight")
+    parser.add_argument("--checkpoint", default = None, help = "checkpoint file, default <docroot>/<feed>.backfill")
+    parser.add_argument("--checkpoint-every", type = float, default = 30, help = "seconds between checkpoints")
+    parser.add_argument("--progress", type = float, default = 10, help = "seconds between progress lines")
+    parser.add_argument("--restart", action = "store_true", help = "ignore the checkpoint and start from the beginning")
+    parser.add_argument("captures", nargs = "+", help = "capture segments, raw stream dumps or directories of them")
+    args = parser.parse_args()
+
+    # a batch job: feeds are written at checkpoints and at the end, pages are purged by purge_dir
+    ga_translate.UCDP_RECONNECT = False
+    ga_translate.CAPTURE_DIR = None
+    ga_translate.PURGE_INTERVAL = 0
+    ga_translate.FEED_FLUSH_ITEMS = sys.maxsize
+    ga_translate.FEED_FLUSH_INTERVAL = None
+    ga_translate.TRANSLATE_BACKEND = args.backend
+    ga_translate.TRANSLATE_RATE = args.rate
+    ga_translate.TRANSLATE_CHAR_RATE = args.char_rate
+    ga_translate.TRANSLATE_MAX_CONCURRENCY = args.concurrency
+
+    files = capture_files(args.captures)
+    total = sum(1 for msg in captured_messages(files))
+    checkpoint = Checkpoint(args.checkpoint or os.path.join(args.docroot, args.feed + ".backfill"), files, total)
+    first = 0 if args.restart else checkpoint.load()
+    if first == None:
+        print("The checkpoint is for other captures, use --restart to start over")
+        sys.exit(1)
+    if first >= total:
+        print("Nothing to do, all %d messages are done" % total)
+        return
+    checkpoint.start_at(first)
+
+    rss = ga_translate.XinhuaTranslatorRSS(rssfeedfilename = args.feed,
+                                           rsstitle        = args.title,
+                                           rssdescription  = args.description,
+                                           rssurlroot      = args.urlroot,
+                                           rssdocroot      = args.docroot,
+                                           rssmaxitems     = args.maxitems,
+                                           UCDP_hostname   = ga_translate.UCDP_hostname,
+                                           UCDP_port       = ga_translate.UCDP_port,
+                                           UCDP_ip         = ga_translate.UCDP_ip,
+                                           UCDP_cert       = ga_translate.UCDP_cert,
+                                           UCDP_certpasswd = ga_translate.UCDP_certpasswd,
+                                           verbose         = False,
+                                           workers         = args.workers,
+                                           queuesize       = 4 * args.workers,
+                                           backpressure    = "block",
+                                           persistent_dedup = False,
+                                           on_commit       = checkpoint.committed_story,
+                                           on_page_written = checkpoint.page_written)
+    for output in ga_translate.RSS_OUTPUTS:
+        rss.add_output(**dict(output, docroot = args.docroot))
+
+    if first > 0:
+        print("Resuming after %d of %d messages" % (first, total))
+    stopping = threading.Event()
+    start = time.time()
+    def reporter():
+        last_checkpoint = time.time()
+        while not stopping.wait(args.progress):
+            report(checkpoint, total, start, first)
+            if time.time() - last_checkpoint >= args.checkpoint_every:
+                checkpoint.save(rss)
+                last_checkpoint = time.time()
+    thread = threading.Thread(target = reporter, daemon = True)
+    thread.start()
+
+    # Ctrl-C only stops the reading: an exception in the middle of a submit could leave
+    # the pipeline waiting for a message that never got queued
+    interrupted = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: interrupted.set())
+    for n, msg in enumerate(captured_messages(files)):
+        if interrupted.is_set():
+            print("Interrupted, finishing the stories already taken")
+            break
+        if n < first:
+            # already published; still remember it, so a later repeat is dropped
+            story = rss.parse_message(msg)
+            if not story.is_tick and story.success and not rss.is_duplicate(story):
+                rss.remember(story)
+            continue
+        rss.dispatch(msg)
+    rss.finish()
+    stopping.set()
+    thread.join()
+
+    done = checkpoint.save()     # finish() has flushed the feeds
+    report(checkpoint, total, start, first)
+    if done < checkpoint.committed:
+        print("Some pages were not written, a rerun carries on after message %d" % done)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Memory per in-flight story in the XinhuaTranslatorRSS pipeline.
+#
+#    ./bench_memory.py [--stories N] [--body-size BYTES] [--workers W] [--tracemalloc]
+#
+# N synthetic stories are pushed through the pipeline with the committer held back,
+# so that every one of them is parsed and translated (by a stub backend) and waiting
+# to be published at the same time.  The resident set size is taken before, at that
+# point, and at the end, and the growth is divided by N.  --tracemalloc also counts
+# the python heap, which is slower but leaves out allocator and interpreter noise.
+
+import os
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import threading
+import tracemalloc
+
+import ga_translate
+from bench_stream import synthetic_story, HERE
+
+
+def rss():
+    # current resident set size in bytes
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def mb(n):
+    return n / (1024.0 * 1024.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Peak memory per in-flight story")
+    parser.add_argument("--stories", type = int, default = 2000, help = "stories in flight at once")
+    parser.add_argument("--body-size", type = int, default = 2000, help = "bytes of body per synthetic story")
+    parser.add_argument("--workers", type = int, default = 4)
+    parser.add_argument("--tracemalloc", action = "store_true", help = "measure the python heap as well")
+    opts = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix = "bench_memory.")
+    ga_translate.TRANSLATE_CACHE_DB = None
+    ga_translate.DEDUP_INDEX = None
+    ga_translate.PURGE_INTERVAL = 0
+    ga_translate.TRANSLATE_RATE = 0
+    ga_translate.TRANSLATE_CHAR_RATE = 0
+    ga_translate.EN_ONLY_T = os.path.join(HERE, "html.template.en_only")
+    ga_translate.CN_ONLY_T = os.path.join(HERE, "html.template.cnh_cnb")
+    ga_translate.ENH_CNB_T = os.path.join(HERE, "html.template.enh_cnb")
+    ga_translate.CNH_ENB_T = os.path.join(HERE, "html.template.cnh_enb")
+
+    # hold the first commit until every story has been processed
+    release = threading.Event()
+    def held(story, outputs):
+        release.wait()
+        return outputs
+
+    rss_generator = ga_translate.XinhuaTranslatorRSS(rssfeedfilename = "bench.xml",
+                                                     rsstitle        = "bench",
+                                                     rssdescription  = "bench",
+                                                     rssurlroot      = "http://localhost/rss",
+                                                     rssdocroot      = workdir,
+                                                     rssmaxitems     = 100,
+                                                     UCDP_hostname   = "localhost",
+                                                     UCDP_port       = 8301,
+                                                     UCDP_ip         = "127.0.0.1",
+                                                     UCDP_cert       = "",
+                                                     UCDP_certpasswd = "",
+                                                     verbose         = False,
+                                                     workers         = opts.workers,
+                                                     queuesize       = opts.stories + 1,
+                                                     backend         = ga_translate.StubBackend(),
+                                                     on_commit       = held)
+
+    messages = [ json.dumps(synthetic_story(n, opts.body_size)).encode("UTF-8") for n in range(opts.stories) ]
+    message_bytes = sum(len(msg) for msg in messages)
+    if opts.tracemalloc:
+        tracemalloc.start()
+    before = rss()
+    heap_before = tracemalloc.get_traced_memory()[0] if opts.tracemalloc else 0
+
+    for msg in messages:
+        rss_generator.dispatch(msg)
+    pipeline = rss_generator._pipeline
+    while len(pipeline._done) < opts.stories - 1:
+        time.sleep(0.01)
+
+    inflight = rss()
+    heap_inflight = tracemalloc.get_traced_memory()[0] if opts.tracemalloc else 0
+    release.set()
+    rss_generator.finish()
+    after = rss()
+
+    n = opts.stories
+    print("stories     %d in flight, %.0f bytes of message each" % (n, message_bytes / float(n)))
+    print("rss         %.1f MB before, %.1f MB in flight, %.1f MB after, %.1f MB peak" %
+          (mb(before), mb(inflight), mb(after), mb(peak_rss())))
+    print("per story   %.0f bytes of rss" % ((inflight - before) / float(n)))
+    if opts.tracemalloc:
+        print("            %.0f bytes of python heap" % ((heap_inflight - heap_before) / float(n)))
+    shutil.rmtree(workdir, ignore_errors = True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# Compare the untangle DOM parse that ga_translate used to do for every story with
+# the streaming RSFExtractor that replaced it.
+#
+#    ./bench_rsf.py [-n ROUNDS] [FILE|DIR ...]
+#
+# Each FILE is either a bare RSF document, captured UCDP json messages or a capture log
+# segment (ticks are skipped).  With no files a synthetic Xinhua-like story is used.
+
+import os
+import sys
+import json
+import time
+import argparse
+import untangle
+
+from ga_translate import RSFExtractor, UCDPFramer, CaptureReader
+
+SYNTHETIC_RSF = u'''<?xml version="1.0" encoding="UTF-8"?>
+<newsMessage xmlns="http://iptc.org/std/nar/2006-10-01/">
+<header><sent>2018-07-21T10:00:00Z</sent><sender>xinhua</sender></header>
+<itemSet><newsItem guid="urn:newsml:xinhua:20180721:1" version="1">
+<itemMeta><itemClass qcode="icls:text"/><provider literal="xinhua"/><versionCreated>2018-07-21T10:00:00Z</versionCreated></itemMeta>
+<contentMeta><headline xml:lang="zh">俄美外长通电话</headline>{subjects}</contentMeta>
+<contentSet><inlineData contenttype="text/plain" xml:lang="zh"><![CDATA[{body}]]></inlineData></contentSet>
+</newsItem></itemSet></newsMessage>'''
+
+
+def synthetic_samples():
+    body = u"　　新华社莫斯科７月２１日电据俄罗斯外交部网站２１日发布的消息，俄罗斯外长拉夫罗夫与美国国务卿蓬佩奥当天通电话，讨论双边关系等问题。\n" * 20
+    subjects = "".join('<subject qcode="N2:%d"><name>s%d</name></subject>' % (i, i) for i in range(40))
+    return [ SYNTHETIC_RSF.replace("{body}", body).replace("{subjects}", subjects) ]
+
+
+def load_samples(paths):
+    samples = []
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [ os.path.join(path, f) for f in sorted(os.listdir(path)) ]
+        else:
+            files.append(path)
+    for fname in files:
+        if fname.endswith(".gacap"):
+            # a capture log segment written with CAPTURE_DIR
+            for when, msg in CaptureReader([ fname ]).messages():
+                js = json.loads(msg.decode("UTF-8"))
+                if 'data' in js:
+                    samples.append(js['data'])
+            continue
+        with open(fname, "rb") as f:
+            raw = f.read()
+        if raw.lstrip().startswith(b"<"):
+            samples.append(raw.decode("UTF-8"))
+            continue
+        for msg in UCDPFramer().feed(raw):
+            js = json.loads(msg.decode("UTF-8"))
+            if 'data' in js:
+                samples.append(js['data'])
+    return samples
+
+
+def untangle_extract(rsf):
+    # what UCDPData.write did before RSFExtractor
+    obj = untangle.parse(rsf)
+    contentSet = obj.newsMessage.itemSet.newsItem.contentSet
+    try:
+        text = str(contentSet.inlineData.cdata)
+        lang = str(contentSet.inlineData['xml:lang'])
+    except AttributeError:
+        text = None
+        lang = None
+    return text, lang
+
+
+def streaming_extract(rsf):
+    html, html_language, text, text_language, itemid = RSFExtractor().extract(rsf)
+    return text, text_language
+
+
+def run(name, extract, samples, rounds):
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    for r in range(rounds):
+        for rsf in samples:
+            extract(rsf)
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - start_cpu
+    n = rounds * len(samples)
+    print("%-10s %8d docs %10.1f docs/s %10.1f us cpu/doc" % (name, n, n / wall, 1e6 * cpu / n))
+    return wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "RSF extraction benchmark")
+    parser.add_argument("-n", "--rounds", type = int, default = 200)
+    parser.add_argument("samples", nargs = "*")
+    args = parser.parse_args()
+
+    samples = load_samples(args.samples) if args.samples else synthetic_samples()
+    if len(samples) == 0:
+        print("No RSF documents found")
+        sys.exit(1)
+
+    # both paths have to agree before the timing means anything
+    for rsf in samples:
+        if untangle_extract(rsf) != streaming_extract(rsf):
+            print("Extractors disagree on a sample")
+            sys.exit(1)
+
+    old = run("untangle", untangle_extract, samples, args.rounds)
+    new = run("expat", streaming_extract, samples, args.rounds)
+    print("speedup    %.1fx" % (old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+# End to end benchmark of XinhuaTranslatorRSS without UCDP or AWS.
+#
+#    ./bench_stream.py [--stories N] [--rate R] [--chunk BYTES] [--latency MS] ... [FILE ...]
+#
+# Three parts:
+#    UCDPStreamer      a local HTTPS server (in its own process) that streams UCDP json
+#                      messages, ticks included, at a given rate and cut into chunks
+#    StubTranslate     stands in for the boto3 translate client, with configurable
+#                      latency and error injection; with --hedge a StubBackend is the
+#                      hedge backend
+#    the driver        runs XinhuaTranslatorRSS against both into a temporary docroot
+#                      and reports stories/s, end to end latency and CPU per story
+#
+# Stories come from FILEs of captured UCDP messages (raw stream dumps, or capture log
+# segments and directories of them), or are generated.  Each story's
+# headline carries "#<n>" so the driver can match feed commits to send times.
+
+import os
+import re
+import ssl
+import json
+import zlib
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+from botocore.exceptions import ClientError
+
+import ga_translate
+from ga_translate import UCDPFramer, CaptureReader
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SYNTHETIC_RSF = u'''<?xml version="1.0" encoding="UTF-8"?>
+<newsMessage xmlns="http://iptc.org/std/nar/2006-10-01/"><header><sent>{sent}</sent></header>
+<itemSet><newsItem guid="urn:newsml:xinhua:bench:{n}"><itemMeta><provider literal="xinhua"/></itemMeta>
+<contentSet><inlineData contenttype="text/plain" xml:lang="zh"><![CDATA[{body}]]></inlineData></contentSet>
+</newsItem></itemSet></newsMessage>'''
+
+SENTENCE = u"新华社莫斯科７月２１日电据俄罗斯外交部网站２１日发布的消息，俄罗斯外长拉夫罗夫与美国国务卿蓬佩奥当天通电话，讨论双边关系等问题。"
+
+
+########################################################################################
+# message sources
+########################################################################################
+def synthetic_story(n, body_size):
+    body = (u"　　" + SENTENCE + u"（%d）\n" % n) * max(1, body_size // len(SENTENCE.encode("UTF-8")))
+    return {'data' : SYNTHETIC_RSF.replace("{n}", str(n)).replace("{sent}", "2018-07-21T10:00:00Z").replace("{body}", body),
+            'language' : "zh",
+            'headline' : u"俄美外长通电话 #%d" % n,
+            'storydate' : "2018-07-21 10:00:00.000"}
+
+
+def captured_stories(paths):
+    # every non-tick message in the files, with "#<n>" added to the headline
+    stories = []
+    for path in paths:
+        if os.path.isdir(path) or path.endswith(".gacap"):
+            # a capture log written with CAPTURE_DIR
+            messages = [ msg for when, msg in CaptureReader([ path ]).messages() ]
+        else:
+            with open(path, "rb") as f:
+                messages = UCDPFramer().feed(f.read())
+        for msg in messages:
+            js = json.loads(msg.decode("UTF-8"))
+            if 'tick' not in js:
+                stories.append(js)
+    for n, js in enumerate(stories):
+        js['headline'] = js.get('headline', "") + u" #%d" % n
+    return stories
+
+
+########################################################################################
+# UCDPStreamer: HTTPS server that plays the stories back as a UCDP stream
+########################################################################################
+class UCDPStreamer(BaseHTTPRequestHandler):
+    # the connection is closed at the end of the stream, as UCDP does when it drops us
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        post = parse_qs(self.rfile.read(length).decode("UTF-8"))
+        compression = post.get('compression', ["none"])[0]
+        compressor = None
+        if compression != "none":
+            wbits = ga_translate.StreamDecompressor.WBITS.get(compression, 16 + zlib.MAX_WBITS)
+            compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+
+        opts = self.server.opts
+        rnd = random.Random(opts.seed)
+        interval = 1.0 / opts.rate if opts.rate > 0 else 0
+        start = time.time()
+        for n, js in enumerate(self.server.stories):
+            if interval > 0:
+                delay = start + n * interval - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            msg = b""
+            if opts.tick_every > 0 and n % opts.tick_every == 0:
+                msg += json.dumps({'tick' : n}).encode("UTF-8") + b"\r\n"
+            js['bench_sent'] = time.time()
+            msg += json.dumps(js, ensure_ascii = False).encode("UTF-8") + b"\r\n"
+            if compressor != None:
+                # a sync flush per message, so each one can be decoded as soon as it arrives
+                msg = compressor.compress(msg) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            # fragment the message like a slow network would
+            pos = 0
+            while pos < len(msg):
+                size = rnd.randint(1, opts.chunk) if opts.chunk > 0 else len(msg)
+                self.wfile.write(msg[pos:pos + size])
+                self.wfile.flush()
+                pos += size
+        # a clean TLS shutdown, so curl sees the end of the stream rather than an error
+        try:
+            self.connection.unwrap()
+        except (ssl.SSLError, OSError):
+            pass
+
+
+def serve(opts, stories, certfile, port, ready):
+    server = HTTPServer(("127.0.0.1", port), UCDPStreamer)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile)
+    server.socket = context.wrap_socket(server.socket, server_side = True)
+    server.opts = opts
+    server.stories = stories
+    ready.set()
+    server.handle_request()
+
+
+def make_certificate(workdir):
+    # self signed, used as the server certificate and as our client certificate
+    pem = os.path.join(workdir, "bench.pem")
+    key = os.path.join(workdir, "bench.key")
+    crt = os.path.join(workdir, "bench.crt")
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key,
+                           "-out", crt, "-subj", "/CN=localhost", "-days", "1"],
+                          stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    with open(pem, "w") as out:
+        for part in (crt, key):
+            with open(part) as f:
+                out.write(f.read())
+    return pem
+
+
+########################################################################################
+# StubTranslate: a stand in for boto3's translate client
+########################################################################################
+class StubTranslate:
+    def __init__(self, latency = 0.05, jitter = 0.5, error_rate = 0.0, seed = None):
+        self._latency = latency
+        self._jitter = jitter
+        self._error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.chars = 0
+        self.errors = 0
+
+    def translate_text(self, Text, SourceLanguageCode, TargetLanguageCode):
+        with self._lock:
+            self.calls += 1
+            self.chars += len(Text)
+            delay = self._latency * (1 + self._jitter * (2 * self._random.random() - 1))
+            fail = self._random.random() < self._error_rate
+            if fail:
+                self.errors += 1
+        time.sleep(max(0, delay))
+        if fail:
+            raise ClientError({'Error' : {'Code' : "ThrottlingException", 'Message' : "stub throttle"}}, "TranslateText")
+        return {'TranslatedText' : u"[" + TargetLanguageCode + u"] " + Text,
+                'SourceLanguageCode' : "zh",
+                'TargetLanguageCode' : TargetLanguageCode}
+
+
+########################################################################################
+# the driver
+########################################################################################
+def percentile(values, p):
+    if len(values) == 0:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "End to end benchmark of ga_translate")
+    parser.add_argument("--stories", type = int, default = 200, help = "synthetic stories to stream")
+    parser.add_argument("--body-size", type = int, default = 2000, help = "bytes of body per synthetic story")
+    parser.add_argument("--rate", type = float, default = 0, help = "stories per second, 0 for as fast as possible")
+    parser.add_argument("--chunk", type = int, default = 1400, help = "largest write to the socket, 0 for whole messages")
+    parser.add_argument("--tick-every", type = int, default = 10, help = "send a tick before every Nth story")
+    parser.add_argument("--latency", type = float, default = 50, help = "mean stub translation latency in ms")
+    parser.add_argument("--jitter", type = float, default = 0.5, help = "latency varies by +/- this fraction")
+    parser.add_argument("--error-rate", type = float, default = 0.0, help = "fraction of translate calls that fail")
+    parser.add_argument("--translate-rate", type = float, default = 0, help = "translate requests per second, 0 for no limit")
+    parser.add_argument("--char-rate", type = float, default = 0, help = "translated characters per second, 0 for no limit")
+    parser.add_argument("--hedge", type = float, default = 0, help = "hedge to a stub backend with this latency in ms, 0 for no hedging")
+    parser.add_argument("--workers", type = int, default = ga_translate.PIPELINE_WORKERS)
+    parser.add_argument("--backpressure", default = ga_translate.PIPELINE_BACKPRESSURE)
+    parser.add_argument("--processes", type = int, default = ga_translate.PROCESS_WORKERS)
+    parser.add_argument("--compression", default = "none", help = "none, gzip, zlib or deflate")
+    parser.add_argument("--port", type = int, default = 8301)
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--keep", action = "store_true", help = "keep the output directory")
+    parser.add_argument("captures", nargs = "*", help = "files of captured UCDP messages to stream instead")
+    opts = parser.parse_args()
+
+    stories = captured_stories(opts.captures) if opts.captures else \
+              [ synthetic_story(n, opts.body_size) for n in range(opts.stories) ]
+    workdir = tempfile.mkdtemp(prefix = "bench_ga_translate.")
+    docroot = os.path.join(workdir, "rss")
+    os.mkdir(docroot)
+    certfile = make_certificate(workdir)
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target = serve, args = (opts, stories, certfile, opts.port, ready))
+    server.start()
+    ready.wait()
+
+    # point the translator at the stub and the repo's templates, and keep the cache out of it
+    stub = StubTranslate(opts.latency / 1000.0, opts.jitter, opts.error_rate, opts.seed)
+    ga_translate.AmazonBackend._client = stub
+    backend = ga_translate.AmazonBackend()
+    if opts.hedge > 0:
+        backend = ga_translate.HedgedBackend(backend, ga_translate.StubBackend(opts.hedge / 1000.0, opts.jitter, seed = opts.seed))
+    ga_translate.TRANSLATE_CACHE_DB = None
+    ga_translate.DEDUP_INDEX = None
+    ga_translate.UCDP_RECONNECT = False
+    ga_translate.UCDP_COMPRESSION = opts.compression
+    ga_translate.TRANSLATE_RATE = opts.translate_rate
+    ga_translate.TRANSLATE_CHAR_RATE = opts.char_rate
+    ga_translate.EN_ONLY_T = os.path.join(HERE, "html.template.en_only")
+    ga_translate.CN_ONLY_T = os.path.join(HERE, "html.template.cnh_cnb")
+    ga_translate.ENH_CNB_T = os.path.join(HERE, "html.template.enh_cnb")
+    ga_translate.CNH_ENB_T = os.path.join(HERE, "html.template.cnh_enb")
+
+    sent = {}
+    latencies = []
+    number = re.compile(r'#(\d+)')
+    rss = ga_translate.XinhuaTranslatorRSS(rssfeedfilename = "bench.xml",
+                                           rsstitle        = "bench",
+                                           rssdescription  = "bench",
+                                           rssurlroot      = "http://localhost/rss",
+                                           rssdocroot      = docroot,
+                                           rssmaxitems     = 100,
+                                           UCDP_hostname   = "localhost",
+                                           UCDP_port       = opts.port,
+                                           UCDP_ip         = "127.0.0.1",
+                                           UCDP_cert       = certfile,
+                                           UCDP_certpasswd = "",
+                                           verbose         = False,
+                                           workers         = opts.workers,
+                                           backpressure    = opts.backpressure,
+                                           spooldir        = workdir,
+                                           processes       = opts.processes,
+                                           backend         = backend)
+
+    # the story's send time rides along in the message; note it when the story is parsed,
+    # and measure when its feed entry is committed
+    parse_message = rss.parse_message
+    def timed_parse(msg, seq = 0):
+        story = parse_message(msg, seq)
+        m = re.search(rb'"bench_sent": ([0-9.]+)', msg)
+        n = number.search(story.headline)
+        if m != None and n != None:
+            sent[int(n.group(1))] = float(m.group(1))
+        return story
+    rss.parse_message = timed_parse
+
+    update_feed = rss._rss.update_feed
+    def timed_update(fname, date, title, description):
+        update_feed(fname, date, title, description)
+        n = number.search(title)
+        if n != None and sent.get(int(n.group(1))) != None:
+            latencies.append(time.time() - sent[int(n.group(1))])
+    rss._rss.update_feed = timed_update
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    rss.run()
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    server.join()
+
+    committed = len(latencies)
+    print("stories     %d sent, %d committed" % (len(stories), committed))
+    print("throughput  %.1f stories/s over %.2f s" % (committed / wall if wall > 0 else 0, wall))
+    print("latency     p50 %.1f ms  p90 %.1f ms  p99 %.1f ms  max %.1f ms" %
+          tuple(1000 * percentile(latencies, p) for p in (50, 90, 99, 100)))
+    print("cpu         %.2f ms/story (%.2f s total)" % (1000 * cpu / committed if committed else 0, cpu))
+    print("translate   %d calls, %d chars, %d injected errors" % (stub.calls, stub.chars, stub.errors))
+    counters = ga_translate.METRICS.snapshot()[0]
+    print("scheduling  %d throttled, %d calls held by the rate limit, %d parts left untranslated" %
+          (counters.get("translate_throttled", 0), counters.get("translate_rate_waits", 0), counters.get("errors_untranslated", 0)))
+    if opts.hedge > 0:
+        print("hedging     %d hedged, %d won by the hedge, %d failovers" %
+              (counters.get("translate_hedged", 0), counters.get("translate_hedge_wins", 0), counters.get("translate_failovers", 0)))
+    print("bytes       %d on the wire, %d after decompression" %
+          (counters.get("bytes_raw", 0), counters.get("bytes_decompressed", 0)))
+    if opts.keep:
+        print("output      " + workdir)
+    else:
+        shutil.rmtree(workdir, ignore_errors = True)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,25 +2,96 @@
 
 
 import json
+import zlib
+import re
 import pycurl
 import feedparser
-from feedgen.feed import FeedGenerator
+from email.utils import format_datetime
+from collections import deque
 import certifi
-import untangle
+from xml.parsers import expat
+from xml.sax.saxutils import escape, unescape, quoteattr
 from datetime import datetime, date, timezone
 import time
 import random
+import os
+import mmap
+import struct
+import fcntl
+import threading
+import queue
+import concurrent.futures
+import multiprocessing
+import hashlib
+import argparse
+import sqlite3
+import unicodedata
+import bisect
+import heapq
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict
 try:
     # python 3
     from urllib.parse import urlencode
 except ImportError:
     # python 2
     from urllib import urlencode
-#from google.cloud import translate
 import six
 import boto3
+from botocore.config import Config
 
 AMAZON_TRANSLATE_LIMIT = 5000
+TRANSLATE_CHUNK_WORKERS = 8     # concurrent calls for the chunks of one long body
+
+# One Amazon Translate client is shared by every translation worker
+AWS_REGION                = "us-east-1"
+TRANSLATE_POOL_SIZE       = 10      # HTTP connections kept alive to the service
+TRANSLATE_CONNECT_TIMEOUT = 5       # seconds
+TRANSLATE_READ_TIMEOUT    = 15      # seconds, so one slow call cannot hold a worker forever
+TRANSLATE_MAX_ATTEMPTS    = 3       # including the first try
+TRANSLATE_RETRY_MODE      = "standard"
+
+# Translation backends: "amazon", "google" (needs google-cloud-translate) or "stub" (local,
+# for testing).  With a hedge backend, a call the primary has not answered within its
+# p95 latency is sent to the hedge backend too, and whichever answers first is used.
+TRANSLATE_BACKEND           = "amazon"
+TRANSLATE_HEDGE_BACKEND     = None      # e.g. "google"
+TRANSLATE_HEDGE_QUANTILE    = 95
+TRANSLATE_HEDGE_MIN_SAMPLES = 50        # primary calls timed before its quantile is trusted
+TRANSLATE_HEDGE_DELAY       = 2.0       # seconds to wait before hedging until then
+TRANSLATE_HEDGE_WORKERS     = 32
+TRANSLATE_LATENCY_WINDOW    = 500       # recent calls kept per backend for the percentiles
+
+# Translation scheduling: calls wait for a token bucket (requests and characters per
+# second, 0 for no limit) and for one of a number of in-flight slots that grows by one
+# per round of good calls and halves on throttling or slow calls (AIMD).  Waiting
+# headlines go before waiting bodies.
+TRANSLATE_RATE             = 50         # requests per second
+TRANSLATE_CHAR_RATE        = 100000     # characters per second
+TRANSLATE_BURST            = 2.0        # seconds' worth of either that can be used at once
+TRANSLATE_MIN_CONCURRENCY  = 1
+TRANSLATE_MAX_CONCURRENCY  = 16
+TRANSLATE_LATENCY_TARGET   = 5.0        # seconds; a slower call counts as congestion
+PRIORITY_HEADLINE          = 0
+PRIORITY_BODY              = 1
+
+# Script detection before translating: text labelled with a CJK language that is
+# (almost) all Latin letters is taken as English and not sent, text that is (almost) all
+# one CJK script is sent with that source language instead of "auto", and in mixed text
+# only the non-Latin sentences are sent.  Any other script, or another language's label
+# on Latin text, is sent with "auto" as before
+SCRIPT_DETECTION  = True
+SCRIPT_CONFIDENCE = 0.9     # share of the letters that must be in one script
+
+# Metrics: a Prometheus style text endpoint on localhost and a json log line every so often
+METRICS_PORT         = 9105     # None to switch the endpoint off
+METRICS_LOG_INTERVAL = 60       # seconds, 0 to switch the log line off
+
+# Translation cache: a small LRU in memory in front of a sqlite file that survives restarts
+TRANSLATE_CACHE_ENTRIES    = 4096
+TRANSLATE_CACHE_DB         = "/home/ec2-user/ga_translate/translate_cache.db"    # None for memory only
+TRANSLATE_CACHE_DB_ENTRIES = 200000
+TRANSLATE_CACHE_MAXAGE     = 30 * 24 * 3600     # seconds
 
 VERBOSE         = False
 UCDP_hostname   = "rests_translate.ucdp.thomsonreuters.com"
@@ -28,6 +99,21 @@ UCDP_port       = 8301
 UCDP_ip         = "10.51.13.15"
 UCDP_cert       = "/home/ec2-user/ga_translate/ucdp_rests_translate.pem"
 UCDP_certpasswd = "password"
+# More streams to read in the same process, e.g. other product codes or a failover endpoint,
+# each a dict of name, hostname, port, ip, cert, certpasswd and optionally post_data
+UCDP_SUBSCRIPTIONS = []
+UCDP_COMPRESSION   = "none"     # "none", "gzip", "zlib" or "deflate"
+
+# When a stream drops, reconnect after a jittered, doubling delay and ask for a replay
+# from the storydate of the last story we saw on it
+UCDP_RECONNECT       = True
+RECONNECT_MIN_DELAY  = 1.0      # seconds
+RECONNECT_MAX_DELAY  = 60.0
+UCDP_REPLAY_FROM     = "replayfrom"     # post field carrying the replay position
+
+# Stories already processed (by item id or content) are dropped before translation
+DEDUP_INDEX   = "/home/ec2-user/ga_translate/dedup.idx"     # None to keep it in memory only
+DEDUP_ENTRIES = 100000
 URLROOT         = "http://10.97.21.48/rss"
 DOCROOT         = "/var/www/html/rss/"
 RSSFEEDFILENAME = "xtest.xml"
@@ -39,34 +125,1174 @@ CN_ONLY_T       = "/home/ec2-user/ga_translate/html.template.cnh_cnb"
 ENH_CNB_T       = "/home/ec2-user/ga_translate/html.template.enh_cnb"
 CNH_ENB_T       = "/home/ec2-user/ga_translate/html.template.cnh_enb"
 
+# More feeds to publish each story to, translated once.  Each is a dict of feed, title,
+# description and optionally urlroot, docroot (default URLROOT, DOCROOT), maxitems,
+# templates (the four template paths, in the order above), english_only (every page
+# from the first template, with the English where there is a translation) and
+# predicate, a function of the Story that says whether it goes in this feed, e.g.
+#    { 'feed' : "xtest_en.xml", 'title' : "Xinhua in English", 'description' : "...",
+#      'english_only' : True,
+#      'predicate' : lambda story: story.headline_is_translated }
+RSS_OUTPUTS     = []
+
+# The feed file is rewritten after this many new items, or this many seconds after the first
+# unwritten one (None to wait for the items or an explicit flush)
+FEED_FLUSH_ITEMS    = 10
+FEED_FLUSH_INTERVAL = 2.0
+
+# Story pages are written by a pool of threads, the feed entry follows once the page is on disk
+PAGE_WRITERS           = 4
+PAGE_WRITE_BACKLOG     = 256    # pages queued or being written before add_*_item blocks
+TEMPLATE_CHECK_INTERVAL = 5.0   # seconds between checks of a template file's mtime
+
+# Every page written is recorded in a manifest (<feed>.pages in the docroot) so that
+# purging only touches expired pages
+PURGE_MAX_AGE   = 5 * 24 * 3600     # seconds a page is kept
+PURGE_INTERVAL  = 3600              # seconds between in-process purges, 0 for none
+PURGE_ON_EVICT  = False             # delete a page as soon as it drops out of the feed
+
+# Where a page goes under the docroot (and the urlroot): strftime fields of the UTC time
+# it was written, plus {id}, a page id unique across processes.  "{id}.html" keeps one
+# flat directory.  Pages already written keep their old names, so their links still work.
+PAGE_LAYOUT     = "%Y/%m/%d/%H/{id}.html"
+# The stylesheet, relative to the feed's urlroot; templates link it as {css}, which is
+# the full URL so that it is found from a page at any depth
+STYLESHEET      = "css/xtest.css"
+
+# Capture every framed message from UCDP into a rotating binary log in this directory,
+# None for no capture.  Segments are rotated after CAPTURE_SEGMENT_BYTES and can be
+# zlib compressed; "ga_translate.py --replay SEGMENT|DIR ..." feeds them back in.
+CAPTURE_DIR           = None
+CAPTURE_SEGMENT_BYTES = 64 * 1024 * 1024
+CAPTURE_COMPRESSION   = "none"          # or "zlib"
+CAPTURE_BUFFER        = 1024 * 1024     # bytes buffered before a write
+CAPTURE_FLUSH_INTERVAL = 1.0            # seconds, at most, that a message stays buffered
+
+# Pipeline mode: 0 workers translates inside the curl write callback (the original behaviour),
+# which holds up every stream in UCDP_SUBSCRIPTIONS while one story is translated
+PIPELINE_WORKERS      = 0
+PIPELINE_QUEUESIZE    = 64
+PIPELINE_BACKPRESSURE = "block"     # "block", "drop_ticks" or "spill"
+PIPELINE_SPOOLDIR     = "/tmp"
+# Processes for RSF extraction, 0 to do it in the pipeline threads.  Only used with
+# PIPELINE_WORKERS > 0; each pipeline thread waits for the message it sent, so at most
+# PIPELINE_WORKERS messages are being extracted at once
+PROCESS_WORKERS       = 0
+
 
 ########################################################################################
-# UCDPData: Get data from UCDP's REST streamer
+# Metrics: counters, gauges and per stage timings for the whole process
+#    Everything is a dict update under one lock, cheap enough to leave on.  Stage
+#    timings are histograms in seconds; a stage can also count the bytes it handled.
+#    render() gives the Prometheus text format, serve() puts it on
+#    http://127.0.0.1:<port>/metrics and start_log() prints a json line periodically.
 ########################################################################################
-class UCDPData:
-    def __init__(self, UCDP_hostname, UCDP_port, UCDP_ip, UCDP_cert, UCDP_certpasswd, verbose):
-        self.html = ""
+class Metrics:
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    PREFIX = "ga_translate_"
+
+    class _Timer:
+        __slots__ = ('_metrics', '_stage', '_nbytes', '_start')
+
+        def __init__(self, metrics, stage, nbytes):
+            self._metrics = metrics
+            self._stage = stage
+            self._nbytes = nbytes
+
+        def __enter__(self):
+            self._start = time.perf_counter()
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            self._metrics.observe(self._stage, time.perf_counter() - self._start, self._nbytes)
+            return False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._stages = {}       # stage -> [bucket counts..., count, sum, bytes]
+        self._gauges = {}       # name -> callable returning a number
+        self._server = None
+
+    def inc(self, name, n = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, stage, seconds, nbytes = 0):
+        i = bisect.bisect_left(self.BUCKETS, seconds)
+        nb = len(self.BUCKETS)
+        with self._lock:
+            h = self._stages.get(stage)
+            if (h == None):
+                h = [0] * (nb + 3)
+                h[nb + 1] = 0.0
+                self._stages[stage] = h
+            h[i] += 1       # i == nb is the +Inf bucket
+            h[nb + 1] += seconds
+            h[nb + 2] += nbytes
+
+    def timer(self, stage, nbytes = 0):
+        # with METRICS.timer("stage"): ...
+        return self._Timer(self, stage, nbytes)
+
+    def take(self):
+        # (counters, stages) counted since the last take(), e.g. in a worker process
+        with self._lock:
+            counters, stages = self._counters, self._stages
+            self._counters = {}
+            self._stages = {}
+        return counters, stages
+
+    def merge(self, counters, stages):
+        # add in what another process's take() returned
+        with self._lock:
+            for name, n in counters.items():
+                self._counters[name] = self._counters.get(name, 0) + n
+            for stage, h in stages.items():
+                mine = self._stages.get(stage)
+                if (mine == None):
+                    self._stages[stage] = list(h)
+                else:
+                    for i in range(len(h)):
+                        mine[i] += h[i]
+
+    def gauge(self, name, fn):
+        self._gauges[name] = fn
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            stages = dict((k, list(v)) for k, v in self._stages.items())
+        gauges = {}
+        for name, fn in list(self._gauges.items()):
+            try:
+                gauges[name] = fn()
+            except Exception:
+                pass
+        return counters, stages, gauges
+
+    def render(self):
+        counters, stages, gauges = self.snapshot()
+        nb = len(self.BUCKETS)
+        lines = []
+        for name in sorted(counters):
+            lines.append("# TYPE %s%s_total counter" % (self.PREFIX, name))
+            lines.append("%s%s_total %s" % (self.PREFIX, name, counters[name]))
+        for name in sorted(gauges):
+            lines.append("# TYPE %s%s gauge" % (self.PREFIX, name))
+            lines.append("%s%s %s" % (self.PREFIX, name, gauges[name]))
+        for stage in sorted(stages):
+            h = stages[stage]
+            metric = self.PREFIX + stage + "_seconds"
+            lines.append("# TYPE %s histogram" % metric)
+            cumulative = 0
+            for bound, n in zip(self.BUCKETS, h):
+                cumulative += n
+                lines.append('%s_bucket{le="%s"} %d' % (metric, bound, cumulative))
+            cumulative += h[nb]
+            lines.append('%s_bucket{le="+Inf"} %d' % (metric, cumulative))
+            lines.append("%s_sum %f" % (metric, h[nb + 1]))
+            lines.append("%s_count %d" % (metric, cumulative))
+            if (h[nb + 2] > 0):
+                lines.append("# TYPE %s%s_bytes_total counter" % (self.PREFIX, stage))
+                lines.append("%s%s_bytes_total %d" % (self.PREFIX, stage, h[nb + 2]))
+        return "\n".join(lines) + "\n"
+
+    def log_line(self):
+        counters, stages, gauges = self.snapshot()
+        nb = len(self.BUCKETS)
+        record = { 'metrics' : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()) }
+        record.update(counters)
+        record.update(gauges)
+        for stage, h in stages.items():
+            count = sum(h[:nb + 1])
+            record[stage + "_count"] = count
+            record[stage + "_ms"] = round(1000 * h[nb + 1] / count, 3) if count else 0
+        return json.dumps(record, sort_keys = True)
+
+    def serve(self, port, host = "127.0.0.1"):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if (self.path.split("?")[0] not in ("/", "/metrics")):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("UTF-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        try:
+            self._server = HTTPServer((host, port), Handler)
+        except OSError as e:
+            print("Metrics endpoint disabled: " + str(e))
+            return
+        t = threading.Thread(target = self._server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def start_log(self, interval):
+        def loop():
+            while True:
+                time.sleep(interval)
+                print(self.log_line(), flush = True)
+        t = threading.Thread(target = loop)
+        t.daemon = True
+        t.start()
+
+
+METRICS = Metrics()
+
+
+########################################################################################
+# UCDPFramer: split the UCDP byte stream into complete json messages
+#    Only the bytes received since the last call are scanned, so a story that
+#    arrives in many segments costs O(size) instead of a json.loads per segment.
+#    Multi-byte UTF-8 sequences never contain ASCII bytes, so scanning the raw
+#    bytes for braces and quotes is safe.
+########################################################################################
+class UCDPFramer:
+    _OUTSIDE = re.compile(rb'[{}"]')
+    _INSIDE = re.compile(rb'["\\]')
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0          # next byte of _buf to scan
+        self._start = -1       # start of the message being framed, -1 if between messages
+        self._depth = 0
+        self._instr = False
+        self.last_segments = 0     # chunks the last complete message arrived in
+        self.pending_segments = 0  # chunks buffered so far for the message in progress
+        self.total_segments = 0    # sum of the segments of every message framed
+
+    def feed(self, data):
+        # returns the list of complete messages (as bytes) that this chunk finished
+        buf = self._buf
+        buf += data
+        pos = self._pos
+        messages = []
+        if (self._start >= 0):
+            self.pending_segments += 1
+        while True:
+            if (self._start < 0):
+                pos = buf.find(b'{', pos)
+                if (pos < 0):
+                    # only whitespace between messages
+                    pos = len(buf)
+                    break
+                self._start = pos
+                self._depth = 1
+                self.pending_segments = 1
+                pos += 1
+            elif (self._instr):
+                m = self._INSIDE.search(buf, pos)
+                if (m == None):
+                    # pos may already be past the end if an escape straddles chunks
+                    pos = max(pos, len(buf))
+                    break
+                if (m.group() == b'"'):
+                    self._instr = False
+                    pos = m.end()
+                else:
+                    # skip the escaped byte, which may not have arrived yet
+                    pos = m.end() + 1
+            else:
+                m = self._OUTSIDE.search(buf, pos)
+                if (m == None):
+                    pos = len(buf)
+                    break
+                pos = m.end()
+                tok = m.group()
+                if (tok == b'"'):
+                    self._instr = True
+                elif (tok == b'{'):
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if (self._depth == 0):
+                        messages.append(bytes(buf[self._start:pos]))
+                        self.last_segments = self.pending_segments
+                        self.total_segments += self.pending_segments
+                        self.pending_segments = 0
+                        self._start = -1
+
+        # drop everything already framed; deleting from the front of a bytearray is cheap
+        keep = self._start if self._start >= 0 else min(pos, len(buf))
+        if (keep > 0):
+            del buf[:keep]
+            pos -= keep
+            if (self._start >= 0):
+                self._start = 0
+        self._pos = pos
+        return messages
+
+    def pending(self):
+        # number of bytes buffered for an incomplete message
+        return len(self._buf) if self._start >= 0 else 0
+
+
+########################################################################################
+# StreamDecompressor: incremental inflate in front of the framing
+#    One decompressor lives for the whole connection, so the window carries over
+#    from message to message and chunks can split the compressed data anywhere.
+#    A new gzip member after the end of the previous one is handled too.
+########################################################################################
+class StreamDecompressor:
+    WBITS = { 'gzip' : 16 + zlib.MAX_WBITS, 'zlib' : zlib.MAX_WBITS, 'deflate' : -zlib.MAX_WBITS }
+
+    def __init__(self, compression):
+        # unknown names get zlib's automatic gzip/zlib header detection
+        self._wbits = self.WBITS.get(compression, 32 + zlib.MAX_WBITS)
+        self._d = zlib.decompressobj(self._wbits)
+        self.raw = 0
+        self.decompressed = 0
+
+    def decompress(self, data):
+        self.raw += len(data)
+        out = self._d.decompress(data)
+        while (self._d.eof and len(self._d.unused_data) > 0):
+            rest = self._d.unused_data
+            self._d = zlib.decompressobj(self._wbits)
+            out += self._d.decompress(rest)
+        self.decompressed += len(out)
+        return out
+
+
+########################################################################################
+# Story: one message from the stream, as it goes from parsing to translation to the feed
+########################################################################################
+class Story:
+    # one of these per story in flight, so no per instance dict
+    __slots__ = ("seq", "is_tick", "success", "duplicate", "itemid", "storydate", "headline", "headline_lang",
+                 "html", "html_language", "text", "text_language", "en_headline", "headline_is_translated",
+                 "en_text", "body_is_translated", "dedup_keys")
+
+    def __init__(self, seq = 0):
+        self.seq = seq
+        self.is_tick = False
+        self.success = False
+        self.duplicate = False
+        self.itemid = None
+        self.storydate = None
         self.headline = ""
         self.headline_lang = ""
-        self.text = ""
+        self.html = ""
         self.html_language = ""
+        self.text = ""
         self.text_language = ""
-        self.storydate = None
-        
-        self._Raw = None
-        self._Rsf = ""
-        self._json = ""
-        self._isTick = False
-        self._segments = 0
-        self._success = False
-        
-        self._c = pycurl.Curl()
-        self._c.setopt(self._c.VERBOSE, verbose)
+        self.en_headline = ""
+        self.headline_is_translated = False
+        self.en_text = ""
+        self.body_is_translated = False
+        self.dedup_keys = None  # reserved in the dedup index until the story is published
+
+
+########################################################################################
+# SpillFile: disk overflow for the pipeline queue, records are [seq][length][message]
+########################################################################################
+class SpillFile:
+    _HEADER = struct.Struct(">QI")
+
+    def __init__(self, spooldir):
+        self._path = os.path.join(spooldir, "ga_translate.%d.spill" % os.getpid())
+        self._f = open(self._path, "w+b")
+        self._rpos = 0
+        self._wpos = 0
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def put(self, seq, msg):
+        with self._lock:
+            self._f.seek(self._wpos)
+            self._f.write(self._HEADER.pack(seq, len(msg)))
+            self._f.write(msg)
+            self._wpos = self._f.tell()
+            self.count += 1
+
+    def get(self):
+        # oldest spilled (seq, message), or None if nothing is spilled
+        with self._lock:
+            if (self.count == 0):
+                return None
+            self._f.seek(self._rpos)
+            seq, n = self._HEADER.unpack(self._f.read(self._HEADER.size))
+            msg = self._f.read(n)
+            self._rpos = self._f.tell()
+            self.count -= 1
+            if (self.count == 0):
+                # everything has been read back, reuse the file from the start
+                self._f.seek(0)
+                self._f.truncate()
+                self._rpos = 0
+                self._wpos = 0
+            return (seq, msg)
+
+    def close(self):
+        self._f.close()
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+
+
+########################################################################################
+# StoryPipeline: take translation out of the curl write callback
+#    The callback only submits framed messages to a bounded queue.  A pool of workers
+#    runs process(msg, seq) concurrently and a single committer thread calls
+#    commit(story) in the order the messages arrived.
+#    backpressure says what submit() does when the queue is full:
+#       "block"      wait for room (UCDP sees a slow consumer)
+#       "drop_ticks" throw away ticks, wait for room for stories
+#       "spill"      append to a spill file in spooldir, fed back in as room frees up
+########################################################################################
+class StoryPipeline:
+    def __init__(self, process, commit, workers = 4, queuesize = 64, backpressure = "block", spooldir = "/tmp"):
+        if (backpressure not in ("block", "drop_ticks", "spill")):
+            raise ValueError("Unknown backpressure policy: " + str(backpressure))
+        self._process = process
+        self._commit = commit
+        self._backpressure = backpressure
+        self._queue = queue.Queue(maxsize = queuesize)
+        self._seq = 0
+        self._next = 0
+        self._done = {}
+        self._cond = threading.Condition()
+        self._closing = False
+        self.dropped = 0
+        self.spilled = 0
+
+        self._spill = None
+        self._spill_ready = threading.Event()
+        self._threads = []
+        if (backpressure == "spill"):
+            self._spill = SpillFile(spooldir)
+            self._unspiller = self._start_thread(self._unspill)
+        self._workers = [ self._start_thread(self._work) for i in range(workers) ]
+        self._committer = self._start_thread(self._commit_loop)
+
+    def _start_thread(self, target):
+        t = threading.Thread(target = target)
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+        return t
+
+    def is_tick(self, msg):
+        # cheap test, ticks are tiny and we do not want to decode them here
+        return len(msg) < 128 and b'"tick"' in msg
+
+    def submit(self, msg):
+        if (self._backpressure == "drop_ticks" and self.is_tick(msg) and self._queue.full()):
+            self.dropped += 1
+            METRICS.inc("pipeline_dropped_ticks")
+            return
+        seq = self._seq
+        self._seq += 1
+        if (self._spill != None):
+            # once something has spilled, keep spilling until the file drains so the
+            # queue stays roughly in order
+            if (self._spill.count == 0):
+                try:
+                    self._queue.put_nowait((seq, msg))
+                    return
+                except queue.Full:
+                    pass
+            self._spill.put(seq, msg)
+            self.spilled += 1
+            METRICS.inc("pipeline_spilled")
+            self._spill_ready.set()
+        else:
+            self._queue.put((seq, msg))
+
+    def _unspill(self):
+        while True:
+            item = self._spill.get()
+            if (item == None):
+                if (self._closing):
+                    return
+                self._spill_ready.wait(0.5)
+                self._spill_ready.clear()
+            else:
+                self._queue.put(item)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if (item == None):
+                return
+            seq, msg = item
+            item = None
+            try:
+                story = self._process(msg, seq)
+            except Exception as e:
+                print("Translation worker failed: " + str(e))
+                METRICS.inc("errors_worker")
+                story = Story(seq)
+            msg = None      # don't hold on to the message (or the story) while idle
+            with self._cond:
+                self._done[seq] = story
+                self._cond.notify_all()
+            story = None
+
+    def _commit_loop(self):
+        while True:
+            with self._cond:
+                while (self._next not in self._done):
+                    if (self._closing and self._next >= self._seq):
+                        return
+                    self._cond.wait()
+                story = self._done.pop(self._next)
+                self._next += 1
+            try:
+                self._commit(story)
+            except Exception as e:
+                print("Commit failed: " + str(e))
+            story = None    # released once committed
+
+    def depth(self):
+        spilled = self._spill.count if self._spill != None else 0
+        return self._queue.qsize() + spilled
+
+    def close(self):
+        # finish everything already submitted, then stop the threads
+        self._closing = True
+        if (self._spill != None):
+            self._spill_ready.set()
+            self._unspiller.join()
+        for w in self._workers:
+            self._queue.put(None)
+        for w in self._workers:
+            w.join()
+        with self._cond:
+            self._cond.notify_all()
+        self._committer.join()
+        if (self._spill != None):
+            self._spill.close()
+
+
+########################################################################################
+# TranslationCache: two tier cache of translations
+#    Keyed on a hash of the normalized source text plus the source and target
+#    languages.  The first tier is an LRU dict of at most memsize entries, the
+#    second a sqlite file of at most dbsize entries.  Entries older than maxage
+#    seconds are treated as missing, and the oldest ones are deleted from the
+#    file when it grows past dbsize.
+########################################################################################
+class TranslationCache:
+    _WHITESPACE = re.compile(r'\s+')
+
+    def __init__(self, memsize = 4096, dbpath = None, dbsize = 200000, maxage = 30 * 24 * 3600):
+        self._memsize = memsize
+        self._dbsize = dbsize
+        self._maxage = maxage
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._db = None
+        if (dbpath != None):
+            try:
+                self._db = sqlite3.connect(dbpath, check_same_thread = False, isolation_level = None)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+                self._db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, translated TEXT, "
+                                 "detected TEXT, created REAL, used REAL)")
+                self._db.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (used)")
+            except sqlite3.Error as e:
+                print("Translation cache disabled on disk: " + str(e))
+                self._db = None
+
+    def key(self, text, source, target):
+        normalized = self._WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+        h = hashlib.sha1(normalized.encode("UTF-8"))
+        h.update(("\0" + source + "\0" + target).encode("UTF-8"))
+        return h.hexdigest()
+
+    def get(self, text, source, target):
+        # returns (translatedText, detectedSourceLanguage) or None
+        k = self.key(text, source, target)
+        now = time.time()
+        with self._lock:
+            entry = self._lru.get(k)
+            if (entry != None and now - entry[2] <= self._maxage):
+                self._lru.move_to_end(k)
+                self.hits += 1
+                return (entry[0], entry[1])
+            if (entry != None):
+                del self._lru[k]
+            if (self._db != None):
+                row = self._db.execute("SELECT translated, detected, created FROM cache WHERE key = ?", (k,)).fetchone()
+                if (row != None and now - row[2] <= self._maxage):
+                    self._db.execute("UPDATE cache SET used = ? WHERE key = ?", (now, k))
+                    self._remember(k, row)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return (row[0], row[1])
+            self.misses += 1
+            return None
+
+    def put(self, text, source, target, translated, detected):
+        k = self.key(text, source, target)
+        now = time.time()
+        with self._lock:
+            self._remember(k, (translated, detected, now))
+            if (self._db != None):
+                try:
+                    self._db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                                     (k, translated, detected, now, now))
+                    self._puts += 1
+                    if (self._puts % 1000 == 0):
+                        self._evict(now)
+                except sqlite3.Error as e:
+                    print("Translation cache write failed: " + str(e))
+
+    def _remember(self, k, entry):
+        self._lru[k] = entry
+        self._lru.move_to_end(k)
+        while (len(self._lru) > self._memsize):
+            self._lru.popitem(last = False)
+
+    def _evict(self, now):
+        self._db.execute("DELETE FROM cache WHERE created < ?", (now - self._maxage,))
+        n = self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if (n > self._dbsize):
+            self._db.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY used LIMIT ?)",
+                             (n - self._dbsize,))
+
+    def stats(self):
+        return { 'hits' : self.hits, 'disk_hits' : self.disk_hits, 'misses' : self.misses, 'entries' : len(self._lru) }
+
+    def close(self):
+        if (self._db != None):
+            with self._lock:
+                self._db.close()
+                self._db = None
+
+
+########################################################################################
+# DedupIndex: the most recent story keys we have processed
+#    Keys (item ids, content hashes) are kept as 16 byte digests in an ordered dict
+#    of at most capacity entries.  Every new digest is appended to the index file,
+#    which is read back at startup and rewritten with just the live entries once it
+#    holds twice the capacity.
+#    check() only reserves the keys of a new story, so that a copy arriving while it
+#    is being translated is dropped; add() records them once the story is published,
+#    and release() gives them up when it should be tried again.  A story still in
+#    flight at a crash is then not lost on the replay.
+########################################################################################
+class DedupIndex:
+    _SIZE = 16
+
+    def __init__(self, path = None, capacity = 100000):
+        self._path = path
+        self._capacity = capacity
+        self._seen = OrderedDict()
+        self._inflight = set()
+        self._lock = threading.Lock()
+        self._f = None
+        self._logged = 0
+        self.duplicates = 0
+        if (path != None):
+            self._load()
+            try:
+                self._f = open(path, "ab")
+            except OSError as e:
+                print("Dedup index not persisted: " + str(e))
+
+    def _load(self):
+        try:
+            with open(self._path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return
+        n = len(data) // self._SIZE
+        for i in range(max(0, n - self._capacity), n):
+            self._seen[data[i * self._SIZE:(i + 1) * self._SIZE]] = True
+        self._logged = n
+        if (len(data) > n * self._SIZE):
+            # a digest torn by a crash; cut it off, or every later one is misaligned
+            try:
+                with open(self._path, "r+b") as f:
+                    f.truncate(n * self._SIZE)
+            except OSError as e:
+                print("Cannot repair dedup index: " + str(e))
+
+    def digest(self, key):
+        return hashlib.blake2b(key.encode("UTF-8"), digest_size = self._SIZE).digest()
+
+    def check(self, keys):
+        # True if any of keys was seen before or is in flight; otherwise reserve them all
+        # and return False
+        digests = [ self.digest(k) for k in keys if k ]
+        with self._lock:
+            for d in digests:
+                if (d in self._seen or d in self._inflight):
+                    if (d in self._seen):
+                        self._seen.move_to_end(d)
+                    self.duplicates += 1
+                    return True
+            self._inflight.update(digests)
+            return False
+
+    def release(self, keys):
+        with self._lock:
+            self._inflight.difference_update(self.digest(k) for k in keys if k)
+
+    def add(self, keys):
+        # remember keys for good, whether or not check() reserved them
+        digests = [ self.digest(k) for k in keys if k ]
+        with self._lock:
+            self._inflight.difference_update(digests)
+            digests = [ d for d in digests if d not in self._seen ]
+            for d in digests:
+                self._seen[d] = True
+                if (len(self._seen) > self._capacity):
+                    self._seen.popitem(last = False)
+            if (self._f != None and len(digests) > 0):
+                try:
+                    self._f.write(b"".join(digests))
+                    self._f.flush()
+                    self._logged += len(digests)
+                    if (self._logged > 2 * self._capacity):
+                        self._compact()
+                except OSError as e:
+                    print("Dedup index write failed: " + str(e))
+
+    def _compact(self):
+        self._f.close()
+        tmp = self._path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(b"".join(self._seen.keys()))
+        os.replace(tmp, self._path)
+        self._f = open(self._path, "ab")
+        self._logged = len(self._seen)
+
+    def close(self):
+        with self._lock:
+            if (self._f != None):
+                self._f.close()
+                self._f = None
+
+
+########################################################################################
+# RSFExtractor: pull the story body out of an RSF document without building a tree
+#    Only newsMessage/itemSet/newsItem/contentSet/{inlineXML,inlineData} and their
+#    xml:lang are kept; parsing stops as soon as the first contentSet has closed.
+#    inlineData gives its own character data (as untangle's .cdata did), inlineXML
+#    gives its inner markup.
+########################################################################################
+class RSFExtractor:
+    _PATH = ('newsMessage', 'itemSet', 'newsItem', 'contentSet')
+
+    class _Done(Exception):
+        pass
+
+    def extract(self, rsf):
+        # returns (html, html_language, text, text_language, itemid), None for the parts
+        # not found; itemid is the newsItem guid, with ":<version>" if it has one
+        # raises expat.ExpatError if the document is malformed before we are done
+        self._itemid = None
+        self._stack = []
+        self._matched = 0       # how many levels of _PATH the open elements match
+        self._capture = None    # 'inlineXML' or 'inlineData' while inside one of them
+        self._depth = 0         # depth inside the captured element
+        self._parts = []
+        self._found = {}
+
+        p = expat.ParserCreate()
+        p.buffer_text = True
+        p.StartElementHandler = self._start
+        p.EndElementHandler = self._end
+        p.CharacterDataHandler = self._chars
+        try:
+            p.Parse(rsf, True)
+        except self._Done:
+            pass
+        html = self._found.get('inlineXML', (None, None))
+        text = self._found.get('inlineData', (None, None))
+        return (html[0], html[1], text[0], text[1], self._itemid)
+
+    def _start(self, name, attrs):
+        local = name.rpartition(':')[2]
+        if (self._capture != None):
+            self._depth += 1
+            if (self._capture == 'inlineXML'):
+                self._parts.append("<" + name + "".join(" " + k + "=" + quoteattr(v) for k, v in attrs.items()) + ">")
+            return
+        level = len(self._stack)
+        self._stack.append(local)
+        if (level == self._matched and level < len(self._PATH) and local == self._PATH[level]):
+            self._matched += 1
+            if (local == 'newsItem' and self._itemid == None and 'guid' in attrs):
+                self._itemid = attrs['guid']
+                if ('version' in attrs):
+                    self._itemid += ":" + attrs['version']
+        elif (self._matched == len(self._PATH) and level == len(self._PATH)
+              and local in ('inlineXML', 'inlineData') and local not in self._found):
+            self._capture = local
+            self._lang = attrs.get('xml:lang')
+            self._depth = 0
+            self._parts = []
+
+    def _end(self, name):
+        if (self._capture != None):
+            if (self._depth > 0):
+                self._depth -= 1
+                if (self._capture == 'inlineXML'):
+                    self._parts.append("</" + name + ">")
+                return
+            self._found[self._capture] = ("".join(self._parts), self._lang)
+            self._capture = None
+        self._stack.pop()
+        if (self._matched > len(self._stack)):
+            if (self._matched == len(self._PATH)):
+                # the contentSet is finished, nothing else in the document is of interest
+                raise self._Done()
+            self._matched = len(self._stack)
+
+    def _chars(self, data):
+        if (self._capture == 'inlineXML'):
+            self._parts.append(escape(data))
+        elif (self._capture == 'inlineData' and self._depth == 0):
+            self._parts.append(data)
+
+
+########################################################################################
+# parse_ucdp_message: one framed message from UCDP into a new Story
+#    A plain function so that it can also run in a worker process.
+########################################################################################
+def parse_ucdp_message(msg, seq = 0):
+    story = Story(seq)
+    rsf = ""
+    try:
+        js = json.loads(msg.decode('UTF-8'))
+    except ValueError:
+        print("Malformed json message from UCDP")
+        METRICS.inc("errors_json")
+        return story
+
+    try:
+        js['tick']
+        story.is_tick = True
+        METRICS.inc("ticks")
+    except KeyError:
+        METRICS.inc("stories")
+    finally:
+        if (not story.is_tick):
+            try:
+                rsf = js['data']
+                story.headline_lang = js['language']
+                story.headline = js['headline']
+                isodate = js['storydate']
+                storydate = datetime.strptime(isodate, "%Y-%m-%d %H:%M:%S.%f")
+                story.storydate = datetime(year=storydate.year, month=storydate.month, day=storydate.day,
+                                           hour=storydate.hour, minute=storydate.minute, second=storydate.second,
+                                           microsecond=storydate.microsecond, tzinfo=timezone.utc)
+            except KeyError:
+                print('Unknown json structure encountered in UCDPData')
+                METRICS.inc("errors_json_structure")
+            finally:
+                js = None   # everything needed is out of it, only the RSF is still referenced
+                try:
+                    with METRICS.timer("rsf_extract"):
+                        html, html_language, text, text_language, itemid = RSFExtractor().extract(rsf)
+                except expat.ExpatError:
+                    print ("RSF fails to parse")
+                    METRICS.inc("errors_rsf")
+                else:
+                    story.itemid = itemid
+                    if (html != None):
+                        story.html = html
+                        story.html_language = html_language if html_language != None else story.headline_lang
+                    if (text != None):
+                        story.text = text
+                        story.text_language = text_language if text_language != None else story.headline_lang
+
+            if (story.html == "" and story.text == ""):
+                print ("ERROR: No story body found")
+                METRICS.inc("errors_no_body")
+            else:
+                story.success = True
+    return story
+
+
+def parse_ucdp_message_counted(msg, seq = 0):
+    # parse_ucdp_message for a worker process: the metrics it bumps there go back to
+    # the parent with the story
+    story = parse_ucdp_message(msg, seq)
+    return story, METRICS.take()
+
+
+########################################################################################
+# CaptureLog: raw framed messages to a rotating binary log
+#    A segment is an 8 byte magic (GACAPR1 plain, GACAPZ1 zlib) followed by records of
+#    [timestamp double][length uint32][message].  In a zlib segment the records are
+#    one deflate stream, sync flushed on every write so a crash loses at most the
+#    buffer.  The buffer is written once it holds buffer bytes, or flush_interval
+#    seconds after the first message went into it.  Segments are named <prefix>.<UTC start time>.<n>.gacap and a new one is
+#    started once segment_bytes of records have gone into the current one.
+########################################################################################
+class CaptureLog:
+    MAGIC_PLAIN = b"GACAPR1\n"
+    MAGIC_ZLIB = b"GACAPZ1\n"
+    RECORD = struct.Struct(">dI")
+
+    def __init__(self, directory, segment_bytes = CAPTURE_SEGMENT_BYTES, compression = CAPTURE_COMPRESSION,
+                 buffer = CAPTURE_BUFFER, flush_interval = CAPTURE_FLUSH_INTERVAL, prefix = "ucdp"):
+        self._directory = directory
+        self._segment_bytes = segment_bytes
+        self._compression = compression
+        self._buffer_size = buffer
+        self._flush_interval = flush_interval
+        self._prefix = prefix
+        self._buffer = []
+        self._buffered = 0
+        self._timer = None
+        self._f = None
+        self._z = None
+        self._written = 0       # record bytes in the current segment
+        self._number = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok = True)
+
+    def _open(self):
+        self._number += 1
+        name = "%s.%s.%06d.gacap" % (self._prefix, datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S"), self._number)
+        self._f = open(os.path.join(self._directory, name), "wb")
+        if (self._compression == "zlib"):
+            self._f.write(self.MAGIC_ZLIB)
+            self._z = zlib.compressobj()
+        else:
+            self._f.write(self.MAGIC_PLAIN)
+            self._z = None
+        self._written = 0
+
+    def _close_segment(self):
+        if (self._z != None):
+            self._f.write(self._z.flush(zlib.Z_FINISH))
+        self._f.close()
+        self._f = None
+
+    def append(self, msg, when = None):
+        record = self.RECORD.pack(when if when != None else time.time(), len(msg))
+        with self._lock:
+            self._buffer.append(record)
+            self._buffer.append(msg)
+            self._buffered += len(record) + len(msg)
+            if (self._buffered >= self._buffer_size):
+                self._flush()
+            elif (self._timer == None):
+                # a quiet stream still gets its messages written
+                self._timer = threading.Timer(self._flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush(self):
+        if (self._timer != None):
+            self._timer.cancel()
+            self._timer = None
+        if (self._buffered == 0):
+            return
+        if (self._f == None):
+            self._open()
+        data = b"".join(self._buffer)
+        if (self._z != None):
+            self._f.write(self._z.compress(data) + self._z.flush(zlib.Z_SYNC_FLUSH))
+        else:
+            self._f.write(data)
+        self._f.flush()
+        METRICS.inc("capture_bytes", len(data))
+        self._written += len(data)
+        self._buffer = []
+        self._buffered = 0
+        if (self._written >= self._segment_bytes):
+            self._close_segment()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if (self._f != None):
+                self._close_segment()
+
+
+########################################################################################
+# CaptureReader: the (timestamp, message) records of CaptureLog segments, in order
+#    Paths can be segments or directories of them.  Plain segments are memory mapped
+#    and each message is sliced straight out of the map; zlib segments are inflated
+#    from the map a block at a time.  A record cut short at the end of a segment
+#    (the writer died) ends that segment.
+########################################################################################
+class CaptureReader:
+    _BLOCK = 1024 * 1024
+
+    def __init__(self, paths):
+        self.segments = []
+        for path in paths:
+            if (os.path.isdir(path)):
+                self.segments += sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".gacap"))
+            else:
+                self.segments.append(path)
+
+    def messages(self):
+        for path in self.segments:
+            for record in self.read_segment(path):
+                yield record
+
+    def read_segment(self, path):
+        with open(path, "rb") as f:
+            if (os.fstat(f.fileno()).st_size <= len(CaptureLog.MAGIC_PLAIN)):
+                return
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                magic = mm[:len(CaptureLog.MAGIC_PLAIN)]
+                if (magic == CaptureLog.MAGIC_PLAIN):
+                    records = self._records(mm, len(magic))
+                elif (magic == CaptureLog.MAGIC_ZLIB):
+                    records = self._inflated(mm, len(magic))
+                else:
+                    print("Not a capture segment: " + path)
+                    METRICS.inc("errors_capture")
+                    return
+                for record in records:
+                    yield record
+
+    def _records(self, buf, pos):
+        header = CaptureLog.RECORD
+        end = len(buf)
+        while (pos + header.size <= end):
+            when, n = header.unpack_from(buf, pos)
+            pos += header.size
+            if (pos + n > end):
+                break
+            yield (when, buf[pos:pos + n])
+            pos += n
+
+    def _inflated(self, mm, pos):
+        z = zlib.decompressobj()
+        pending = b""
+        header = CaptureLog.RECORD
+        try:
+            while (pos < len(mm) and not z.eof):
+                pending += z.decompress(mm[pos:pos + self._BLOCK])
+                pos += self._BLOCK
+                used = 0
+                for when, msg in self._records(pending, 0):
+                    used += header.size + len(msg)
+                    yield (when, msg)
+                pending = pending[used:]
+        except zlib.error as e:
+            print("Capture segment damaged: " + str(e))
+            METRICS.inc("errors_capture")
+
+
+########################################################################################
+# UCDPSubscription: one stream from UCDP's REST streamer
+#    Each subscription has its own curl handle and framing state; the complete
+#    messages go to the owning UCDPData's dispatch(), so every stream shares the
+#    same translation and feed.
+########################################################################################
+class UCDPSubscription:
+    _STORYDATE = re.compile(rb'"storydate"\s*:\s*"([^"]+)"')
+
+    def __init__(self, owner, name, hostname, port, ip, cert, certpasswd, verbose = False, post_data = None):
+        self.name = name
+        self._owner = owner
+        self._config = (hostname, port, ip, cert, certpasswd, verbose)
+        if (post_data == None):
+            post_data = { 'compression' : UCDP_COMPRESSION, 'replay' : False }
+        self._post_data = post_data
+        self.position = None        # storydate of the last story received
+        self.delay = 0              # current reconnect backoff
+        self.handle = None
+        self.open()
+
+    def open(self, replay = False):
+        # a fresh handle and framing state; with replay, ask for everything since position
+        hostname, port, ip, cert, certpasswd, verbose = self._config
+        post_data = dict(self._post_data)
+        if (replay):
+            post_data['replay'] = True
+            if (self.position != None):
+                post_data[UCDP_REPLAY_FROM] = self.position
+        self.framer = UCDPFramer()
+        self.decompressor = None
+        if (str(post_data.get('compression', 'none')).lower() != 'none'):
+            self.decompressor = StreamDecompressor(str(post_data['compression']).lower())
+        self.received = 0
+        self.handle = pycurl.Curl()
+        c = self.handle
+        c.setopt(c.VERBOSE, verbose)
         # not strictly needed, except if UCDP ever goes to real certs
-        self._c.setopt(self._c.CAINFO, certifi.where())
-        self.set_ServerNameIndication(self._c, UCDP_hostname, UCDP_port, UCDP_ip)
-        self.set_Certificate(self._c, UCDP_cert, UCDP_certpasswd)
-        self.set_Postfields(self._c, post_data = { 'compression' : 'none', 'replay' : False } )
+        c.setopt(c.CAINFO, certifi.where())
+        self._owner.set_ServerNameIndication(c, hostname, port, ip)
+        self._owner.set_Certificate(c, cert, certpasswd)
+        self._owner.set_Postfields(c, post_data)
+        c.setopt(c.WRITEFUNCTION, self.write)
+        return c
+
+    def write(self, data):
+        self.received += len(data)
+        METRICS.inc("bytes_raw", len(data))
+        if (self.decompressor != None):
+            try:
+                data = self.decompressor.decompress(data)
+            except zlib.error as e:
+                # the rest of this connection is garbage; returning 0 makes curl abort it
+                print("Stream fails to decompress: " + str(e))
+                METRICS.inc("errors_decompress")
+                return 0
+        METRICS.inc("bytes_decompressed", len(data))
+        for msg in self._owner.frame(data, self.framer):
+            m = self._STORYDATE.search(msg)
+            if (m != None):
+                self.position = m.group(1).decode("UTF-8")
+            self._owner.dispatch(msg)
+
+    def backoff(self):
+        # seconds to wait before reconnecting: full jitter over a doubling delay,
+        # which starts again from the minimum once a connection has delivered data
+        if (self.received > 0):
+            self.delay = 0
+        self.delay = min(RECONNECT_MAX_DELAY, max(RECONNECT_MIN_DELAY, 2 * self.delay))
+        return random.uniform(RECONNECT_MIN_DELAY / 2, self.delay)
+
+    def close(self):
+        if (self.handle != None):
+            self.handle.close()
+            self.handle = None
+
+
+########################################################################################
+# UCDPData: Get data from UCDP's REST streamer
+########################################################################################
+class UCDPData:
+    def __init__(self, UCDP_hostname, UCDP_port, UCDP_ip, UCDP_cert, UCDP_certpasswd, verbose):
+        # the stories themselves are Story objects passed from stage to stage, nothing
+        # about the current one is kept here
+        self._verbose = verbose
+        self._stopping = False
+        self._capture = None
+        if (CAPTURE_DIR != None):
+            self._capture = CaptureLog(CAPTURE_DIR, CAPTURE_SEGMENT_BYTES, CAPTURE_COMPRESSION,
+                                       CAPTURE_BUFFER, CAPTURE_FLUSH_INTERVAL)
+        self._subscriptions = []
+        self.add_subscription("primary", UCDP_hostname, UCDP_port, UCDP_ip, UCDP_cert, UCDP_certpasswd)
+
+    def add_subscription(self, name, hostname, port, ip, cert, certpasswd, post_data = None):
+        sub = UCDPSubscription(self, name, hostname, port, ip, cert, certpasswd, self._verbose, post_data)
+        self._subscriptions.append(sub)
+        return sub
 
     def set_ServerNameIndication(self, c, hostname, port, ip):
         resolve = hostname + ":" + str(port) + ":" + ip
@@ -84,330 +1310,1348 @@ class UCDPData:
         postfields = urlencode(post_data)
         c.setopt(c.POSTFIELDS, postfields)
 
-    def clear(self):
-        self.html = ""
-        self.headline = ""
-        self.headline_lang = ""
-        self.text = ""
-        self.html_language = ""
-        self.text_language = ""
-        self.storydate = None
-        self._success = False
+    def frame(self, data, framer):
+        # a chunk may hold part of a message, or several messages back to back
+        METRICS.inc("chunks")
+        segments = framer.total_segments
+        with METRICS.timer("framing", len(data)):
+            messages = framer.feed(data)
+        if (len(messages) > 0):
+            METRICS.inc("messages", len(messages))
+            METRICS.inc("message_segments", framer.total_segments - segments)
+            if (self._capture != None):
+                for msg in messages:
+                    self._capture.append(msg)
+        return messages
+
+    def dispatch(self, msg):
+        self.on_message(msg)
+
+    def on_message(self, msg):
+        # msg is the bytes of exactly one complete json message (tick or story)
+        self.on_story(self.parse_message(msg))
+
+    def on_story(self, story):
+        # the end of the line for a story, subclasses publish it here
+        if (self._verbose):
+            self.print_result(story)
+
+    def parse_message(self, msg, seq = 0):
+        # does not touch self, so it is safe to call from the pipeline workers
+        return parse_ucdp_message(msg, seq)
+
+    def stop(self):
+        # makes run() return after the current pass, without reconnecting
+        self._stopping = True
+
+    def run(self):
+        # drive every subscription from one CurlMulti; with UCDP_RECONNECT a stream that
+        # ends or fails is reopened with replay after its backoff, otherwise run()
+        # returns once all of them have ended
+        m = pycurl.CurlMulti()
+        active = {}
+        reconnect = {}      # subscription -> time to reopen it
+        for sub in self._subscriptions:
+            m.add_handle(sub.handle)
+            active[sub.handle] = sub
+        while ((len(active) > 0 or len(reconnect) > 0) and not self._stopping):
+            ret = pycurl.E_CALL_MULTI_PERFORM
+            while (ret == pycurl.E_CALL_MULTI_PERFORM):
+                ret, running = m.perform()
+            while True:
+                queued, ended, failed = m.info_read()
+                closed = [ (c, "Stream ended: " + active[c].name) for c in ended ]
+                closed += [ (c, "Stream interrupted: " + active[c].name + " (" + errmsg + ")") for c, errno, errmsg in failed ]
+                for c, reason in closed:
+                    print(reason)
+                    METRICS.inc("stream_interruptions")
+                    sub = active.pop(c)
+                    m.remove_handle(c)
+                    sub.close()
+                    if (UCDP_RECONNECT and not self._stopping):
+                        reconnect[sub] = time.time() + sub.backoff()
+                if (queued == 0):
+                    break
+
+            now = time.time()
+            for sub, when in list(reconnect.items()):
+                if (when <= now):
+                    print("Reconnecting: " + sub.name)
+                    METRICS.inc("stream_reconnects")
+                    del reconnect[sub]
+                    m.add_handle(sub.open(replay = True))
+                    active[sub.handle] = sub
+
+            if (len(active) == 0 and len(reconnect) == 0):
+                break
+            # curl says how long it can wait; 0 means it has buffered data to process now
+            timeout = m.timeout() / 1000.0 if len(active) > 0 else 1.0
+            if (len(reconnect) > 0):
+                wait = max(0, min(reconnect.values()) - time.time())
+                timeout = wait if timeout < 0 else min(timeout, wait)
+            if (timeout != 0):
+                if (len(active) > 0):
+                    m.select(timeout if timeout > 0 else 1.0)
+                else:
+                    time.sleep(timeout)
+        for sub in active.values():
+            m.remove_handle(sub.handle)
+            sub.close()
+        m.close()
+        self.finish()
+
+    def replay(self, paths, speed = 0):
+        # feed captured messages through dispatch() as if they had just arrived, as
+        # fast as they can be taken (speed 0) or at speed times the captured pace
+        first = None
+        start = time.time()
+        for when, msg in CaptureReader(paths).messages():
+            if (self._stopping):
+                break
+            if (speed > 0):
+                if (first == None):
+                    first = when
+                wait = (when - first) / speed - (time.time() - start)
+                if (wait > 0):
+                    time.sleep(wait)
+            METRICS.inc("messages")
+            METRICS.inc("replayed")
+            self.dispatch(msg)
+        self.finish()
+
+    def finish(self):
+        # run() or replay() is done
+        if (self._capture != None):
+            self._capture.close()
         
-    def write(self, data):
-        # This is the received data from UCDP
-        self._isTick = False
-        self._success = False
-        if (self._Raw == None):
-            self._Raw = data
-        else:
-            self._Raw += data
-            
+    def print_result(self, story):
+        print ("storydate => ", story.storydate)
+        print ("headline =>" + story.headline)
+        print ("headline_lang =>" + story.headline_lang)
+
+        print ("language =>" + story.text_language)
+        print ("body =>\n" + story.text)
+
+########################################################################################
+# ScriptDetector: guess a text's language from the scripts of its letters
+#    Han, kana, hangul and Latin letters, and letters of any other script, are
+#    counted with one regex pass each (in C, no per character python).  detect()
+#    gives "en" (mostly Latin, which the caller only believes for text labelled
+#    with a CJK language: Spanish is Latin too), "zh", "ja" or "ko" when one script
+#    has at least confidence of the letters, "" when there are no letters, else None;
+#    always None if there is Cyrillic, Arabic, Thai or any other script.
+#    The katakana middle dot and long vowel mark are left out of kana, Chinese uses
+#    them too (in transliterated names), and a text is only "ja" if at least
+#    KANA_SHARE of its han and kana are kana; a stray kana in Chinese is not enough.
+########################################################################################
+class ScriptDetector:
+    KANA_SHARE = 0.1
+
+    _HAN = re.compile(r'[\u3005\u3007\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]')
+    _KANA = re.compile(r'[\u3040-\u30fa\u30fd-\u30ff\u31f0-\u31ff]')
+    _HANGUL = re.compile(r'[\u1100-\u11ff\u3130-\u318f\uac00-\ud7af]')
+    _LATIN = re.compile(r'[A-Za-z\u00c0-\u024f\uff21-\uff3a\uff41-\uff5a]')
+    _LETTER = re.compile(r'[^\W\d_\u30fc]')
+
+    def __init__(self, confidence = SCRIPT_CONFIDENCE):
+        self._confidence = confidence
+
+    def counts(self, text):
+        # (han, kana, hangul, latin, other) letters
+        han = len(self._HAN.findall(text))
+        kana = len(self._KANA.findall(text))
+        hangul = len(self._HANGUL.findall(text))
+        latin = len(self._LATIN.findall(text))
+        other = max(0, len(self._LETTER.findall(text)) - han - kana - hangul - latin)
+        return (han, kana, hangul, latin, other)
+
+    def detect(self, text):
+        han, kana, hangul, latin, other = self.counts(text)
+        letters = han + kana + hangul + latin + other
+        if (letters == 0):
+            return ""
+        if (other > 0):
+            return None
+        if (latin >= self._confidence * letters):
+            return "en"
+        if (kana >= self.KANA_SHARE * (han + kana) and han + kana >= self._confidence * letters):
+            return "ja"     # japanese mixes kanji and kana
+        if (han >= self._confidence * letters):
+            return "zh"
+        if (hangul + han >= self._confidence * letters and hangul > 0):
+            return "ko"
+        return None
+
+
+def unicode_truncate(s, length, encoding='utf-8'):
+    encoded = s.encode(encoding)[:length]
+    return encoded.decode(encoding, 'ignore')
+
+
+########################################################################################
+# TranslateBackend: a translation service
+#    Not used on its own: a subclass must define translate_text(text, source, target)
+#    returning {'input', 'translatedText', 'detectedSourceLanguage'}.  Callers use
+#    translate(), which times the call and keeps the latest latencies for percentile().
+#    Latency gauges are only exported by add_gauges(), under a name the caller picks,
+#    so that two backends of the same kind do not overwrite each other's.
+########################################################################################
+class TranslateBackend:
+    def __init__(self, name, limit = AMAZON_TRANSLATE_LIMIT, window = TRANSLATE_LATENCY_WINDOW):
+        self.name = name
+        self.limit = limit      # UTF-8 bytes per call
+        self._latencies = deque(maxlen = window)
+        self._lock = threading.Lock()
+
+    def add_gauges(self, prefix):
+        METRICS.gauge(prefix + "_p50_seconds", lambda: self.percentile(50))
+        METRICS.gauge(prefix + "_p95_seconds", lambda: self.percentile(95))
+
+    def translate(self, text, source = "auto", target = "en"):
+        start = time.perf_counter()
         try:
-            self._json = json.loads(self._Raw.decode('UTF-8'))
-        except:
-            pass # may not be complete
-            self._segments += 1
-        else:
-            self._Raw = None
-            self._segments = 0
-            try:
-                self._json['tick']
-                self._isTick = True
-            except KeyError:
-                pass
-            finally:
-                if (not self._isTick):
-                    try:
-                        self._Rsf = self._json['data']
-                        self.headline_lang = self._json['language']
-                        self.headline = self._json['headline']
-                        isodate = self._json['storydate']
-                        storydate = datetime.strptime(isodate, "%Y-%m-%d %H:%M:%S.%f")
-                        self.storydate = datetime(year=storydate.year, month=storydate.month, day=storydate.day,
-                                                  hour=storydate.hour, minute=storydate.minute, second=storydate.second,
-                                                  microsecond=storydate.microsecond, tzinfo=timezone.utc)
-                    except KeyError:
-                        print('Unknown json structure encountered in UCDPData')
-                    finally:
-                        try:
-                            obj = untangle.parse(self._Rsf)
-                        except:
-                            print ("RSF fails to parse")
-                        finally:
-                            try:
-                                storybody = str(obj.newsMessage.itemSet.newsItem.contentSet.inlineXML)
-                                try:
-                                    storylang = str(obj.newsMessage.itemSet.newsItem.contentSet.inlineXML['xml:lang'])
-                                except:
-                                    storylang = self.headline_lang
-                                finally:
-                                    self.html = storybody
-                                    self.html_language = storylang
-                            except (NameError, AttributeError):
-                                pass
-                            finally:
-                                try:
-                                    storybody = str(obj.newsMessage.itemSet.newsItem.contentSet.inlineData.cdata)
-                                    try:
-                                        storylang = str(obj.newsMessage.itemSet.newsItem.contentSet.inlineData['xml:lang'])
-                                    except:
-                                        storylang = self.headline_lang
-                                    finally:
-                                        self.text = storybody
-                                        self.text_language = storylang
-                                except (NameError, AttributeError):
-                                    pass
-
-                    if (self.html == "" and self.text == ""):
-                        print ("ERROR: No story body found")
-                    else:
-                        self._success = True
-                        
-    def run(self):
-        self._c.setopt(self._c.WRITEDATA, self)
+            with METRICS.timer("translate_" + self.name, len(text.encode('UTF-8'))):
+                result = self.translate_text(text, source, target)
+        except Exception:
+            METRICS.inc("errors_translate_" + self.name)
+            raise
+        with self._lock:
+            self._latencies.append(time.perf_counter() - start)
+        return result
+
+    def samples(self):
+        return len(self._latencies)
+
+    def percentile(self, q):
+        # of the latest successful calls, in seconds; None before the first
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if (len(latencies) == 0):
+            return None
+        return latencies[min(len(latencies) - 1, int(q / 100.0 * len(latencies)))]
+
+
+########################################################################################
+# AmazonBackend: Amazon Translate
+#    boto3 clients are thread safe once built, so one is built and shared
+########################################################################################
+class AmazonBackend(TranslateBackend):
+    _client = None
+    _client_lock = threading.Lock()
+
+    def __init__(self, poolsize = TRANSLATE_POOL_SIZE):
+        TranslateBackend.__init__(self, "amazon")
+        self.get_client(poolsize)
+
+    @classmethod
+    def get_client(cls, poolsize = TRANSLATE_POOL_SIZE):
+        # the first caller decides the pool size; credentials and endpoints are resolved once
+        if (cls._client == None):
+            with cls._client_lock:
+                if (cls._client == None):
+                    config = Config(region_name = AWS_REGION,
+                                    max_pool_connections = poolsize,
+                                    tcp_keepalive = True,
+                                    connect_timeout = TRANSLATE_CONNECT_TIMEOUT,
+                                    read_timeout = TRANSLATE_READ_TIMEOUT,
+                                    retries = { 'total_max_attempts' : TRANSLATE_MAX_ATTEMPTS,
+                                                'mode' : TRANSLATE_RETRY_MODE })
+                    session = boto3.session.Session()
+                    cls._client = session.client(service_name='translate', config=config)
+        return cls._client
+
+    def translate_text(self, text, source, target):
+        if (len(text.encode('UTF-8')) > self.limit):
+            # Translator.translate_text splits long text first, this is only a last resort
+            text = unicode_truncate(text, self.limit)
+        result = self.get_client().translate_text(Text=text, SourceLanguageCode=source, TargetLanguageCode=target)
+        return {'input' : text, 'translatedText' : result.get('TranslatedText'), 'detectedSourceLanguage' : result.get('SourceLanguageCode') }
+
+
+########################################################################################
+# GoogleBackend: Google Cloud Translation (v2), only imported when it is used
+########################################################################################
+class GoogleBackend(TranslateBackend):
+    def __init__(self):
+        TranslateBackend.__init__(self, "google")
+        from google.cloud import translate
+        self._client = translate.Client()
+
+    def translate_text(self, text, source, target):
+        if (len(text.encode('UTF-8')) > self.limit):
+            text = unicode_truncate(text, self.limit)
+        args = { 'target_language' : target, 'format_' : "text" }
+        if (source != "auto"):
+            args['source_language'] = source
+        result = self._client.translate(text, **args)
+        return {'input' : text, 'translatedText' : result['translatedText'],
+                'detectedSourceLanguage' : result.get('detectedSourceLanguage', source) }
+
+
+########################################################################################
+# StubBackend: a local stand in with configurable latency and failures, for testing
+#    "translates" to "[en] " + text
+########################################################################################
+class StubBackend(TranslateBackend):
+    def __init__(self, latency = 0.0, jitter = 0.0, error_rate = 0.0, seed = None, name = "stub"):
+        TranslateBackend.__init__(self, name)
+        self._latency = latency
+        self._jitter = jitter
+        self._error_rate = error_rate
+        self._random = random.Random(seed)
+        self.calls = 0
+        self.chars = 0
+        self.errors = 0
+
+    def translate_text(self, text, source, target):
+        with self._lock:
+            self.calls += 1
+            self.chars += len(text)
+            delay = self._latency * (1 + self._jitter * (2 * self._random.random() - 1))
+            fail = self._random.random() < self._error_rate
+            if (fail):
+                self.errors += 1
+        time.sleep(max(0, delay))
+        if (fail):
+            raise RuntimeError("stub translation failure")
+        return {'input' : text, 'translatedText' : u"[" + target + u"] " + text,
+                'detectedSourceLanguage' : source if source != "auto" else "zh" }
+
+
+########################################################################################
+# HedgedBackend: primary, and secondary too if the primary is slow
+#    The primary gets until its TRANSLATE_HEDGE_QUANTILE latency (TRANSLATE_HEDGE_DELAY
+#    until it has enough samples); after that the same request goes to the secondary
+#    and the first good answer wins.  A primary that fails outright is retried on the
+#    secondary.  The losing call cannot be cancelled, it finishes in the background.
+########################################################################################
+class HedgedBackend(TranslateBackend):
+    def __init__(self, primary, secondary, quantile = TRANSLATE_HEDGE_QUANTILE,
+                 min_samples = TRANSLATE_HEDGE_MIN_SAMPLES, delay = TRANSLATE_HEDGE_DELAY):
+        TranslateBackend.__init__(self, "hedged", min(primary.limit, secondary.limit))
+        self._primary = primary
+        self._secondary = secondary
+        self._quantile = quantile
+        self._min_samples = min_samples
+        self._delay = delay
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers = TRANSLATE_HEDGE_WORKERS)
+
+    def hedge_delay(self):
+        if (self._primary.samples() < self._min_samples):
+            return self._delay
+        return self._primary.percentile(self._quantile)
+
+    def translate_text(self, text, source, target):
+        first = self._pool.submit(self._primary.translate, text, source, target)
         try:
-            self._c.perform()
-        except:
-            print("Stream interrupted")
-        self._c.close()
-        
-    def print_result(self):
-        print ("storydate => ", self.storydate)
-        print ("headline =>" + self.headline)
-        print ("headline_lang =>" + self.headline_lang)
+            return first.result(timeout = self.hedge_delay())
+        except concurrent.futures.TimeoutError:
+            METRICS.inc("translate_hedged")
+        except Exception:
+            METRICS.inc("translate_failovers")
+            return self._secondary.translate(text, source, target)
+
+        second = self._pool.submit(self._secondary.translate, text, source, target)
+        pending = set([ first, second ])
+        while (len(pending) > 0):
+            done, pending = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if (future.exception() == None):
+                    if (future is second):
+                        METRICS.inc("translate_hedge_wins")
+                    return future.result()
+        return first.result()   # both failed, raise the primary's error
+
+
+def make_translate_backend(name = TRANSLATE_BACKEND, hedge = TRANSLATE_HEDGE_BACKEND, poolsize = TRANSLATE_POOL_SIZE):
+    def make(name):
+        if (name == "amazon"):
+            return AmazonBackend(poolsize)
+        if (name == "google"):
+            return GoogleBackend()
+        if (name == "stub"):
+            return StubBackend()
+        raise ValueError("unknown translation backend " + repr(name))
+    backend = make(name)
+    backend.add_gauges("translate_" + name)
+    if (hedge != None):
+        secondary = make(hedge)
+        secondary.add_gauges("translate_hedge_" + hedge)
+        backend = HedgedBackend(backend, secondary)
+        backend.add_gauges("translate_hedged")
+    return backend
+
+
+########################################################################################
+# TokenBucket: rate per second, up to burst seconds' worth saved up
+########################################################################################
+class TokenBucket:
+    def __init__(self, rate, burst = TRANSLATE_BURST):
+        self.rate = rate
+        self.capacity = rate * burst
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+
+    def wait_time(self, n):
+        # seconds until n tokens are there (0 if they are); a request bigger than
+        # the bucket only has to wait for a full one
+        if (self.rate <= 0):
+            return 0.0
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        n = min(n, self.capacity)
+        if (self._tokens >= n):
+            return 0.0
+        return (n - self._tokens) / self.rate
+
+    def take(self, n):
+        if (self.rate > 0):
+            self._tokens -= min(n, self.capacity)
+
+
+########################################################################################
+# TranslateScheduler: rate limits, concurrency control and priorities for a backend
+#    translate() blocks the caller until its request is the most urgent one waiting
+#    (lowest priority number, then first come), an in-flight slot is free and the
+#    token buckets allow it.  The number of slots is adjusted AIMD style: +1/limit for
+#    every good call, halved when a call is throttled or slower than the latency
+#    target, but only once for the calls that were already in flight at the time.
+########################################################################################
+class TranslateScheduler:
+    _THROTTLED = ("ThrottlingException", "TooManyRequestsException", "LimitExceededException",
+                  "ServiceUnavailableException", "SlowDown")
+
+    def __init__(self, backend, rate = TRANSLATE_RATE, char_rate = TRANSLATE_CHAR_RATE,
+                 min_concurrency = TRANSLATE_MIN_CONCURRENCY, max_concurrency = TRANSLATE_MAX_CONCURRENCY,
+                 latency_target = TRANSLATE_LATENCY_TARGET):
+        self._backend = backend
+        self.limit = backend.limit
+        self._requests = TokenBucket(rate)
+        self._chars = TokenBucket(char_rate)
+        self._min = min_concurrency
+        self._max = max_concurrency
+        self._concurrency = float(max_concurrency)
+        self._latency_target = latency_target
+        self._decreased = 0.0   # when the limit was last cut
+        self._inflight = 0
+        self._waiting = []      # heap of (priority, ticket)
+        self._ticket = 0
+        self._cond = threading.Condition()
+        METRICS.gauge("translate_concurrency_limit", lambda: int(self._concurrency))
+        METRICS.gauge("translate_inflight", lambda: self._inflight)
+        METRICS.gauge("translate_waiting", lambda: len(self._waiting))
+
+    def is_throttled(self, e):
+        error = getattr(e, "response", None)
+        if (not isinstance(error, dict)):
+            return False
+        return error.get("Error", {}).get("Code") in self._THROTTLED
+
+    def acquire(self, nchars, priority):
+        with self._cond:
+            self._ticket += 1
+            me = (priority, self._ticket)
+            heapq.heappush(self._waiting, me)
+            counted = False
+            while True:
+                wait = None
+                if (self._waiting[0] == me and self._inflight < int(self._concurrency)):
+                    wait = max(self._requests.wait_time(1), self._chars.wait_time(nchars))
+                    if (wait == 0.0):
+                        break
+                    if (not counted):
+                        METRICS.inc("translate_rate_waits")
+                        counted = True
+                self._cond.wait(wait)
+            heapq.heappop(self._waiting)
+            self._requests.take(1)
+            self._chars.take(nchars)
+            self._inflight += 1
+            self._cond.notify_all()     # the next in line may go too
+        return time.monotonic()
+
+    def release(self, started, congested):
+        with self._cond:
+            self._inflight -= 1
+            if (congested):
+                if (started >= self._decreased):
+                    self._concurrency = max(self._min, self._concurrency / 2)
+                    self._decreased = time.monotonic()
+            else:
+                self._concurrency = min(self._max, self._concurrency + 1.0 / self._concurrency)
+            self._cond.notify_all()
+
+    def translate(self, text, source = "auto", target = "en", priority = PRIORITY_BODY):
+        started = self.acquire(len(text), priority)
+        congested = False
+        try:
+            result = self._backend.translate(text, source, target)
+            congested = time.monotonic() - started > self._latency_target
+            return result
+        except Exception as e:
+            if (self.is_throttled(e)):
+                METRICS.inc("translate_throttled")
+                congested = True
+            raise
+        finally:
+            self.release(started, congested)
 
-        print ("language =>" + self.text_language)
-        print ("body =>\n" + self.text)
 
 ########################################################################################
 # Translator: Get data from UCDP's REST streamer and translate it using Amazon Translate
 #    extends UCDPData
 ########################################################################################
 class Translator(UCDPData):
-    def __init__(self, UCDP_hostname, UCDP_port, UCDP_ip, UCDP_cert, UCDP_certpasswd, verbose):
+    _chunk_pool = concurrent.futures.ThreadPoolExecutor(max_workers = TRANSLATE_CHUNK_WORKERS)
+
+    # a piece of text up to and including a sentence end (CJK or western) and any
+    # closing quotes/brackets, or up to and including a run of newlines
+    _SENTENCE = re.compile(r'.*?(?:[。！？!?；;]+[”’」』）)\]"\']*|\.+[”’」』）)\]"\']*(?=\s|$)|\n+)|.+$', re.S)
+    _EDGES = re.compile(r'^(\s*)(.*?)(\s*)$', re.S)
+
+    def __init__(self, UCDP_hostname, UCDP_port, UCDP_ip, UCDP_cert, UCDP_certpasswd, verbose,
+                 workers = PIPELINE_WORKERS, queuesize = PIPELINE_QUEUESIZE,
+                 backpressure = PIPELINE_BACKPRESSURE, spooldir = PIPELINE_SPOOLDIR,
+                 processes = PROCESS_WORKERS, backend = None, persistent_dedup = True):
+        # persistent_dedup False keeps the dedup index in memory, whatever DEDUP_INDEX says
         UCDPData.__init__(self, UCDP_hostname, UCDP_port, UCDP_ip, UCDP_cert, UCDP_certpasswd, verbose)
-        self.clear()
+        self._procpool = None
+        if (processes > 0 and workers == 0):
+            # the curl callback would sit waiting on the worker process for every message
+            print("PROCESS_WORKERS needs PIPELINE_WORKERS > 0, extracting in this thread")
+        elif (processes > 0):
+            # spawn rather than fork: by now this process has threads and open handles
+            self._procpool = concurrent.futures.ProcessPoolExecutor(max_workers = processes,
+                                                                    mp_context = multiprocessing.get_context("spawn"))
+        self._backend = backend
+        if (self._backend == None):
+            self._backend = make_translate_backend(TRANSLATE_BACKEND, TRANSLATE_HEDGE_BACKEND,
+                                                   max(TRANSLATE_POOL_SIZE, workers))
+        self._detector = ScriptDetector(SCRIPT_CONFIDENCE) if SCRIPT_DETECTION else None
+        self._scheduler = TranslateScheduler(self._backend, TRANSLATE_RATE, TRANSLATE_CHAR_RATE,
+                                             TRANSLATE_MIN_CONCURRENCY, TRANSLATE_MAX_CONCURRENCY,
+                                             TRANSLATE_LATENCY_TARGET)
+        self._cache = TranslationCache(TRANSLATE_CACHE_ENTRIES, TRANSLATE_CACHE_DB,
+                                       TRANSLATE_CACHE_DB_ENTRIES, TRANSLATE_CACHE_MAXAGE)
+        self._dedup = DedupIndex(DEDUP_INDEX if persistent_dedup else None, DEDUP_ENTRIES)
+        self._pipeline = None
+        if (workers > 0):
+            self._pipeline = StoryPipeline(self.process_message, self.on_story,
+                                           workers, queuesize, backpressure, spooldir)
+            METRICS.gauge("pipeline_queue_depth", self._pipeline.depth)
 
-    def clear(self):
-        self.en_headline = ""
-        self.headline_is_translated = False
-        self.en_text = ""
-        self.body_is_translated = False
-        
-    def unicode_truncate(self, s, length, encoding='utf-8'):
-        encoded = s.encode(encoding)[:length]
-        return encoded.decode(encoding, 'ignore')
-
-    def amazon_translate_text(self, text):
-        b = bytes(text, 'UTF-8')
-        if (len(b) > AMAZON_TRANSLATE_LIMIT):
-            text = self.unicode_truncate(text, AMAZON_TRANSLATE_LIMIT)
-        
-        translate_client = boto3.client(service_name='translate', region_name='us-east-1')
-        result = translate_client.translate_text(Text=text, SourceLanguageCode="auto", TargetLanguageCode="en")
-        return {'input' : text, 'translatedText' : result.get('TranslatedText'), 'detectedSourceLanguage' : result.get('SourceLanguageCode') }
+    def split_text(self, text, limit = AMAZON_TRANSLATE_LIMIT):
+        # split text into chunks of at most limit UTF-8 bytes, breaking only after a
+        # sentence or paragraph where possible; "".join(chunks) == text
+        chunks = []
+        current = ""
+        size = 0
+        for piece in self._SENTENCE.findall(text):
+            n = len(piece.encode('UTF-8'))
+            if (size + n > limit and size > 0):
+                chunks.append(current)
+                current = ""
+                size = 0
+            while (n > limit):
+                # one sentence longer than the limit, cut it on a character boundary
+                head = unicode_truncate(piece, limit)
+                chunks.append(head)
+                piece = piece[len(head):]
+                n = len(piece.encode('UTF-8'))
+            current += piece
+            size += n
+        if (size > 0):
+            chunks.append(current)
+        return chunks
 
-    #def google_translate_text(text):
-    #    """Translates text into the target language.
-    #
-    #    Target must be an ISO 639-1 language code.
-    #    See https://g.co/cloud/translate/v2/translate-reference#supported_languages
-    #    """
-    #    translate_client = translate.Client()
-    #
-    #    if isinstance(text, six.binary_type):
-    #        text = text.decode('utf-8')
-    #
-    #    # Text can also be a sequence of strings, in which case this method
-    #    # will return a sequence of results for each text.
-    #    result = translate_client.translate(text, target_language="en")
-    #    
-    #    return result
-        
-    def translate(self):
-        if (not self._isTick and self.headline_lang.lower() != "en" and self._success and len(self.headline) > 0):
-            en_headline = self.amazon_translate_text(self.headline)
-            self.en_headline = en_headline['translatedText']
-            self.headline_is_translated = True
+    def translate_chunk(self, text, source = "auto", target = "en", priority = PRIORITY_BODY):
+        # ask the backend, unless we have translated this text before
+        cached = self._cache.get(text, source, target)
+        if (cached != None):
+            METRICS.inc("translate_cache_hits")
+            return {'input' : text, 'translatedText' : cached[0], 'detectedSourceLanguage' : cached[1] }
+        METRICS.inc("translate_cache_misses")
+        try:
+            with METRICS.timer("translate_call", len(text.encode('UTF-8'))):
+                result = self._scheduler.translate(text, source, target, priority)
+        except Exception:
+            METRICS.inc("errors_translate")
+            raise
+        self._cache.put(text, source, target, result['translatedText'], result['detectedSourceLanguage'])
+        return result
 
-        if (not self._isTick and self.text_language.lower() != "en" and self._success and len(self.text) > 0):
-            en_text = self.amazon_translate_text(self.text)
-            self.en_text = en_text['translatedText']
-            self.body_is_translated = True
+    def translate_text(self, text, source = "auto", target = "en", priority = PRIORITY_BODY):
+        if (len(text.encode('UTF-8')) <= self._backend.limit):
+            return self.translate_chunk(text, source, target, priority)
 
-    def write(self, data):
-        UCDPData.write(self, data)
-        self.translate()
-        
-    def print_result(self):
-        if (not self._isTick):
-            print ("storydate => ", self.storydate)
-            print ("headline =>" + self.headline)
-            print ("headline_lang =>" + self.headline_lang)
-            if (self.headline_is_translated):
-                print (u'Translation:\n{}\n'.format(self.en_headline))
+        # too long for one call: translate the chunks concurrently, then put them back
+        # together in order with the whitespace (paragraph breaks) around each chunk kept
+        chunks = self.split_text(text, self._backend.limit)
+        edges = [ self._EDGES.match(chunk).groups() for chunk in chunks ]
+        futures = [ self._chunk_pool.submit(self.translate_chunk, core, source, target, priority) if len(core) > 0 else None
+                    for (lead, core, trail) in edges ]
+        translated = ""
+        detected = None
+        for (lead, core, trail), future in zip(edges, futures):
+            if (future == None):
+                translated += lead + trail
+                continue
+            result = future.result()
+            if (detected == None):
+                detected = result['detectedSourceLanguage']
+            translated += lead + result['translatedText'] + trail
+        return {'input' : text, 'translatedText' : translated, 'detectedSourceLanguage' : detected }
+
+    def skipped(self, text):
+        METRICS.inc("translate_skipped_calls", len(self.split_text(text, self._backend.limit)))
+        METRICS.inc("translate_skipped_chars", len(text))
+
+    def is_english(self, language, label):
+        # detect() says Latin; that is English only if the label does not say otherwise
+        return (language == "en" and label.lower().split("-")[0] in ("en", "zh", "ja", "ko"))
+
+    def translate_mixed(self, text, label, priority):
+        # text that is partly English: send runs of non-English sentences, keep the rest
+        runs = []
+        for piece in self._SENTENCE.findall(text):
+            language = self._detector.detect(piece)
+            english = self.is_english(language, label)
+            if (language == "" and len(runs) > 0):
+                runs[-1][1] += piece    # no letters, goes with whatever precedes it
+            elif (len(runs) > 0 and runs[-1][0] == english):
+                runs[-1][1] += piece
+            else:
+                runs.append([ english, piece ])
+        translated = ""
+        for english, run in runs:
+            lead, core, trail = self._EDGES.match(run).groups()
+            if (english or len(core) == 0):
+                if (english):
+                    METRICS.inc("translate_skipped_chars", len(core))
+                translated += run
+                continue
+            source = self._detector.detect(core)
+            if (source == None or source == "" or source == "en"):
+                source = "auto"
+            translated += lead + self.translate_text(core, source, "en", priority)['translatedText'] + trail
+        return translated
+
+    def translate_part(self, text, label, priority):
+        # the English for text labelled as language label, or None when it should not
+        # (or need not) be translated
+        if (self._detector == None):
+            return self.translate_text(text, priority = priority)['translatedText']
+        language = self._detector.detect(text)
+        if (language == "" or self.is_english(language, label)):
+            self.skipped(text)
+            return None
+        if (language == "en"):
+            return self.translate_text(text, priority = priority)['translatedText']
+        if (language == None):
+            return self.translate_mixed(text, label, priority)
+        return self.translate_text(text, language, "en", priority)['translatedText']
+
+    def translate_story(self, story):
+        # a part that cannot be translated is published as it is
+        if (not story.is_tick and story.headline_lang.lower() != "en" and story.success and len(story.headline) > 0):
+            try:
+                en_headline = self.translate_part(story.headline, story.headline_lang, PRIORITY_HEADLINE)
+                if (en_headline != None):
+                    story.en_headline = en_headline
+                    story.headline_is_translated = True
+            except Exception as e:
+                print("Headline translation failed: " + str(e))
+                METRICS.inc("errors_untranslated")
+                self.forget(story)
+
+        if (not story.is_tick and story.text_language.lower() != "en" and story.success and len(story.text) > 0):
+            try:
+                en_text = self.translate_part(story.text, story.text_language, PRIORITY_BODY)
+                if (en_text != None):
+                    story.en_text = en_text
+                    story.body_is_translated = True
+            except Exception as e:
+                print("Body translation failed: " + str(e))
+                METRICS.inc("errors_untranslated")
+                self.forget(story)
+        return story
+
+    def parse_message(self, msg, seq = 0):
+        if (self._procpool == None):
+            return UCDPData.parse_message(self, msg, seq)
+        # the raw bytes go to a worker process and a Story comes back, with the
+        # counters and timings the worker took
+        story, (counters, stages) = self._procpool.submit(parse_ucdp_message_counted, msg, seq).result()
+        METRICS.merge(counters, stages)
+        return story
+
+    def is_duplicate(self, story):
+        # a replayed story we have already published (or are translating), by item id
+        # or by content; a new story's keys stay reserved until remember() or forget()
+        content = hashlib.sha1((story.headline + "\0" + story.html + "\0" + story.text).encode("UTF-8")).hexdigest()
+        keys = [ "content:" + content ]
+        if (story.itemid != None):
+            keys.append("id:" + story.itemid)
+        if (self._dedup.check(keys)):
+            return True
+        story.dedup_keys = keys
+        return False
+
+    def remember(self, story):
+        # the story is published, a replay of it is a duplicate from now on
+        if (story.dedup_keys != None):
+            self._dedup.add(story.dedup_keys)
+            story.dedup_keys = None
+
+    def forget(self, story):
+        # the story goes out untranslated, so a replay should translate it again
+        if (story.dedup_keys != None):
+            self._dedup.release(story.dedup_keys)
+            story.dedup_keys = None
+
+    def process_message(self, msg, seq = 0):
+        story = self.parse_message(msg, seq)
+        if (not story.is_tick and story.success and self.is_duplicate(story)):
+            METRICS.inc("duplicates")
+            story.duplicate = True
+            story.success = False
+            return story
+        story.html = ""     # only needed for the duplicate check, the pages use the text
+        return self.translate_story(story)
+
+    def dispatch(self, msg):
+        if (self._pipeline == None):
+            self.on_message(msg)
+        else:
+            # just hand off, the workers parse and translate
+            self._pipeline.submit(msg)
+
+    def on_message(self, msg):
+        self.on_story(self.process_message(msg))
+
+    def on_story(self, story):
+        UCDPData.on_story(self, story)
+        self.remember(story)
+
+    def run(self):
+        if (self._pipeline == None and len(self._subscriptions) > 1):
+            # all the streams share one CurlMulti, so they take turns with the translations
+            print("PIPELINE_WORKERS is 0: every stream waits while a story is translated")
+        UCDPData.run(self)
+
+    def finish(self):
+        UCDPData.finish(self)
+        if (self._pipeline != None):
+            self._pipeline.close()
+        if (self._procpool != None):
+            self._procpool.shutdown()
+        self.close_outputs()
+        self._cache.close()
+        self._dedup.close()
+
+    def close_outputs(self):
+        # every story is committed; subclasses finish publishing here, while the dedup
+        # index can still record what they publish
+        pass
+
+    def print_result(self, story):
+        if (not story.is_tick):
+            print ("storydate => ", story.storydate)
+            print ("headline =>" + story.headline)
+            print ("headline_lang =>" + story.headline_lang)
+            if (story.headline_is_translated):
+                print (u'Translation:\n{}\n'.format(story.en_headline))
+
+            print ("language =>" + story.text_language)
+            print ("body =>\n" + story.text)
+            if (story.body_is_translated):
+                print (u'Translation:\n{}\n'.format(story.en_text))
+
+########################################################################################
+# FeedStore: the items of an RSS feed, kept as pre-rendered <item> fragments
+#    The newest maxitems fragments are kept in a ring, so publishing a story renders
+#    one item instead of the whole feed.  The file is rewritten (temp file + rename,
+#    so readers never see half of it) once flush_items items are waiting or
+#    flush_interval seconds after the first of them arrived, whichever is sooner.
+#    Alongside the feed file a sidecar (path + ".state") logs every flushed item as
+#    [length][UTF-8 fragment], so a restart can reload the ring without parsing the
+#    feed XML.  The log is rewritten with just the live items when it gets long.
+########################################################################################
+class FeedStore:
+    _MAGIC = b"GAFEED1\n"
+    _LENGTH = struct.Struct(">I")
+
+    _GUID = re.compile(r'<guid[^>]*>([^<]*)</guid>')
+
+    def __init__(self, path, title, link, description, maxitems = 100,
+                 flush_items = FEED_FLUSH_ITEMS, flush_interval = FEED_FLUSH_INTERVAL, on_evict = None):
+        self._path = path
+        self._on_evict = on_evict       # called with the guid of each item pushed out of the feed
+        self._statepath = path + ".state"
+        self._unsaved = []
+        self._logged = 0
+        self._items = deque(maxlen = maxitems)
+        self._flush_items = flush_items
+        self._flush_interval = flush_interval
+        self._pending = 0
+        self._timer = None
+        self._lock = threading.RLock()
+        self._head = (u"<?xml version='1.0' encoding='UTF-8'?>\n"
+                      u'<rss xmlns:atom="http://www.w3.org/2005/Atom" '
+                      u'xmlns:content="http://purl.org/rss/1.0/modules/content/" version="2.0"><channel>'
+                      u"<title>" + escape(title) + u"</title>"
+                      u"<link>" + escape(link) + u"</link>"
+                      u"<description>" + escape(description) + u"</description>"
+                      u"<docs>http://www.rssboard.org/rss-specification</docs>"
+                      u"<generator>ga_translate</generator>")
+        self._tail = u"</channel></rss>\n"
+
+    def render_item(self, guid, title, description, link, pubdate):
+        # pubdate is a datetime, or an already formatted RFC 822 string
+        if (isinstance(pubdate, datetime)):
+            pubdate = format_datetime(pubdate)
+        return (u"<item><title>" + escape(title) + u"</title>"
+                u"<link>" + escape(link) + u"</link>"
+                u"<description>" + escape(description) + u"</description>"
+                u'<guid isPermaLink="false">' + escape(guid) + u"</guid>"
+                u"<pubDate>" + escape(pubdate) + u"</pubDate></item>")
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item):
+        # item is a fragment from render_item; the newest item goes first in the feed
+        with self._lock:
+            evicted = None
+            if (len(self._items) == self._items.maxlen):
+                evicted = self._items[-1]
+            self._items.appendleft(item)
+            self._unsaved.append(item)
+            if (evicted != None and self._on_evict != None):
+                m = self._GUID.search(evicted)
+                if (m != None):
+                    self._on_evict(unescape(m.group(1)))
+            self._pending += 1
+            if (self._pending >= self._flush_items):
+                self.flush()
+            elif (self._timer == None and self._flush_interval != None):
+                self._timer = threading.Timer(self._flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def append(self, item):
+        # add an item older than everything already in the store (used when reloading)
+        with self._lock:
+            if (len(self._items) < self._items.maxlen):
+                self._items.append(item)
+
+    def flush(self):
+        with self._lock, METRICS.timer("feed_flush"):
+            if (self._timer != None):
+                self._timer.cancel()
+                self._timer = None
+            self._pending = 0
+            tmp = self._path + ".tmp"
+            with open(tmp, "w", encoding = "UTF-8") as f:
+                f.write(self._head)
+                f.write(u"<lastBuildDate>" + format_datetime(datetime.now(timezone.utc)) + u"</lastBuildDate>")
+                f.write(u"".join(self._items))
+                f.write(self._tail)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._path)
+            self._save_state()
+
+    def _save_state(self):
+        if (self._logged + len(self._unsaved) > 4 * self._items.maxlen):
+            self.save_state()
+            return
+        try:
+            with open(self._statepath, "ab") as f:
+                if (f.tell() == 0):
+                    f.write(self._MAGIC)
+                for item in self._unsaved:
+                    b = item.encode("UTF-8")
+                    f.write(self._LENGTH.pack(len(b)))
+                    f.write(b)
+                f.flush()
+                os.fsync(f.fileno())
+            self._logged += len(self._unsaved)
+            self._unsaved = []
+        except OSError as e:
+            print("Cannot write feed state: " + str(e))
+
+    def save_state(self):
+        # rewrite the sidecar with only the items currently in the feed, oldest first
+        with self._lock:
+            tmp = self._statepath + ".tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(self._MAGIC)
+                    for item in reversed(self._items):
+                        b = item.encode("UTF-8")
+                        f.write(self._LENGTH.pack(len(b)))
+                        f.write(b)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self._statepath)
+                self._logged = len(self._items)
+                self._unsaved = []
+            except OSError as e:
+                print("Cannot write feed state: " + str(e))
+
+    def load_state(self):
+        # refill the ring from the sidecar; False if there is no usable sidecar
+        try:
+            with open(self._statepath, "rb") as f:
+                data = f.read()
+        except OSError:
+            return False
+        if (not data.startswith(self._MAGIC)):
+            return False
+        items = deque(maxlen = self._items.maxlen)
+        pos = len(self._MAGIC)
+        count = 0
+        try:
+            while (pos + self._LENGTH.size <= len(data)):
+                n = self._LENGTH.unpack_from(data, pos)[0]
+                if (pos + self._LENGTH.size + n > len(data)):
+                    break   # torn last record from a crash
+                items.appendleft(data[pos + self._LENGTH.size:pos + self._LENGTH.size + n].decode("UTF-8"))
+                pos += self._LENGTH.size + n
+                count += 1
+        except UnicodeDecodeError:
+            return False
+        with self._lock:
+            self._items = items
+            self._logged = count
+            if (pos < len(data)):
+                # drop the torn bytes, or the next append would follow them
+                self.save_state()
+        return True
+
+    def close(self):
+        with self._lock:
+            if (self._pending > 0 or self._timer != None):
+                self.flush()
+
+
+########################################################################################
+# PageTemplate: an html template read once and re-read only when its file changes
+#    Like the original code, a template that is not a readable file is taken to be
+#    the template text itself.
+########################################################################################
+class PageTemplate:
+    def __init__(self, template, check_interval = TEMPLATE_CHECK_INTERVAL):
+        self._source = template
+        self._check_interval = check_interval
+        self._mtime = None
+        self._checked = 0
+        self._load()
+
+    def _load(self):
+        try:
+            mtime = os.stat(self._source).st_mtime
+            with open(self._source, "r", encoding = "UTF-8") as f:
+                text = f.read()
+        except (OSError, ValueError):
+            mtime = None
+            text = self._source
+        self._mtime = mtime
+        self._checked = time.time()
+        self._text = text
+        self._format = text.format
+
+    def _check(self):
+        if (self._mtime != None and time.time() - self._checked > self._check_interval):
+            self._checked = time.time()
+            try:
+                if (os.stat(self._source).st_mtime != self._mtime):
+                    self._load()
+            except OSError:
+                pass    # keep using what we have
+
+    def text(self):
+        self._check()
+        return self._text
+
+    def render(self, *args, **fields):
+        # args fill the positional {} fields, fields the named ones such as {css}
+        self._check()
+        with METRICS.timer("html_render"):
+            return self._format(*args, **fields)
+
+
+########################################################################################
+# PageWriter: write-behind for story pages
+#    write() queues the page and returns.  A pool of threads writes each page to a
+#    temp file, fsyncs it and renames it into place; then the page's on_durable
+#    callback runs.  Callbacks run in the order write() was called, so the feed keeps
+#    story order even when the pages finish out of order.  A page that cannot be
+#    written gets its on_failed callback instead, if it has one.
+########################################################################################
+class PageWriter:
+    def __init__(self, workers = PAGE_WRITERS, backlog = PAGE_WRITE_BACKLOG):
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+        self._slots = threading.BoundedSemaphore(backlog)
+        self._inflight = deque()
+        self._lock = threading.Lock()
+        self._dirs = set()      # directories known to exist
+        METRICS.gauge("page_write_backlog", lambda: len(self._inflight))
+
+    def write(self, path, content, on_durable, on_failed = None):
+        self._slots.acquire()
+        future = self._pool.submit(self._write, path, content)
+        with self._lock:
+            self._inflight.append((future, on_durable, on_failed))
+        future.add_done_callback(self._done)
+
+    def _write(self, path, content):
+        tmp = path + ".tmp"
+        directory = os.path.dirname(path)
+        if (directory not in self._dirs):
+            os.makedirs(directory, exist_ok = True)
+            self._dirs.add(directory)
+        with METRICS.timer("page_write"):
+            with open(tmp, "w", encoding = "UTF-8") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+
+    def _done(self, future):
+        # commit every finished page at the head of the line
+        with self._lock:
+            while (len(self._inflight) > 0 and self._inflight[0][0].done()):
+                future, on_durable, on_failed = self._inflight.popleft()
+                self._slots.release()
+                try:
+                    if (future.exception() != None):
+                        print("Cannot write page: " + str(future.exception()))
+                        METRICS.inc("errors_page_write")
+                        if (on_failed != None):
+                            on_failed()
+                    else:
+                        on_durable()
+                except Exception as e:
+                    print("Commit after page write failed: " + str(e))
+
+    def paused(self):
+        # hold it (with) and no on_durable callback runs until it is released
+        return self._lock
+
+    def close(self):
+        self._pool.shutdown(wait = True)
+
+
+########################################################################################
+# PageManifest: append-only, time ordered list of the pages we have written
+#    Each line is "<created epoch> <file name>".  Lines are only ever appended in
+#    time order, so the expired pages are always a prefix: purge() reads from the
+#    first live line (remembered in <manifest>.pos) until it meets one that has not
+#    expired, which costs O(expired) rather than a scan of the whole docroot.  The
+#    dead prefix is cut off once it is more than half the file.  An flock keeps the
+#    ingester and a standalone purge_dir.py from stepping on each other.
+########################################################################################
+class PageManifest:
+    def __init__(self, path, docroot):
+        self._path = path
+        self._pospath = path + ".pos"
+        self._docroot = docroot
+
+    def add(self, fname, created = None):
+        if (created == None):
+            created = time.time()
+        line = ("%.3f %s\n" % (created, fname)).encode("UTF-8")
+        try:
+            while True:
+                with open(self._path, "ab") as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    # a compaction may have renamed a new file into place while we
+                    # waited for the lock, then this one is no longer the manifest
+                    if (os.fstat(f.fileno()).st_ino == os.stat(self._path).st_ino):
+                        f.write(line)
+                        return
+        except OSError as e:
+            print("Cannot update page manifest: " + str(e))
+
+    def _position(self):
+        try:
+            with open(self._pospath, "r") as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _set_position(self, pos):
+        tmp = self._pospath + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(pos))
+        os.replace(tmp, self._pospath)
+
+    def remove_page(self, fname):
+        try:
+            os.remove(self._docroot + fname)
+            return True
+        except FileNotFoundError:
+            return False    # already gone, e.g. deleted when it left the feed
+
+    def purge(self, max_age, now = None):
+        # remove the pages older than max_age seconds; returns how many were removed
+        if (now == None):
+            now = time.time()
+        cutoff = now - max_age
+        removed = 0
+        dirs = set()
+        try:
+            f = open(self._path, "r+b")
+        except FileNotFoundError:
+            return 0
+        with f, METRICS.timer("purge"):
+            fcntl.flock(f, fcntl.LOCK_EX)
+            pos = self._position()
+            f.seek(pos)
+            while True:
+                line = f.readline()
+                if (len(line) == 0 or not line.endswith(b"\n")):
+                    break
+                created, _, fname = line.decode("UTF-8").rstrip("\n").partition(" ")
+                try:
+                    if (float(created) >= cutoff):
+                        break
+                except ValueError:
+                    pass    # a garbled line, drop it
+                if (self.remove_page(fname)):
+                    removed += 1
+                if ("/" in fname):
+                    dirs.add(os.path.dirname(fname))
+                pos += len(line)
+
+            size = f.seek(0, os.SEEK_END)
+            if (pos > 0 and pos * 2 > size):
+                # rewrite with only the live lines
+                f.seek(pos)
+                rest = f.read()
+                tmp = self._path + ".tmp"
+                with open(tmp, "wb") as out:
+                    out.write(rest)
+                # position first: a crash before the rename then only means the dead
+                # lines are read (and their pages found gone) once more
+                pos = 0
+                self._set_position(pos)
+                os.replace(tmp, self._path)
+            else:
+                self._set_position(pos)
+            self.remove_empty_dirs(dirs)
+        METRICS.inc("pages_purged", removed)
+        return removed
+
+    def remove_empty_dirs(self, dirs):
+        # shard directories that the purge has emptied, deepest first
+        for d in sorted(dirs, key = len, reverse = True):
+            while (d != ""):
+                try:
+                    os.rmdir(self._docroot + d)
+                except OSError:
+                    break   # not empty (or already gone)
+                d = os.path.dirname(d)
+
+    def start_purging(self, max_age, interval):
+        # purge() every interval seconds on a daemon thread
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.purge(max_age)
+                except Exception as e:
+                    print("Purge failed: " + str(e))
+        t = threading.Thread(target = loop)
+        t.daemon = True
+        t.start()
+
+
+########################################################################################
+# PageIdGenerator: unique, increasing page ids
+#    An id is the current time in microseconds, bumped past the last id handed out
+#    so that ids never repeat or go backwards within the process, even in a burst or
+#    if the clock steps back.  One generator is shared by every feed in the process;
+#    the page names add the process id, so that a backfill and the live ingester
+#    writing to the same docroot cannot replace each other's pages.
+########################################################################################
+class PageIdGenerator:
+    def __init__(self):
+        self._last = 0
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            self._last = max(int(time.time() * 1000000), self._last + 1)
+            return self._last
 
-            print ("language =>" + self.text_language)
-            print ("body =>\n" + self.text)
-            if (self.body_is_translated):
-                print (u'Translation:\n{}\n'.format(self.en_text))
 
 ########################################################################################
 # MyRSSFeed: make an RSS feed
 ########################################################################################
 class myRSSFeed:
-    def __init__(self, feed, title, description, urlroot, docroot = "./rss", maxitems = 100):
+    _ids = PageIdGenerator()
+
+    def __init__(self, feed, title, description, urlroot, docroot = "./rss", maxitems = 100,
+                 layout = None, pages = None, on_page_written = None):
+        # pages is a PageWriter shared with other feeds, or None for one of our own;
+        # on_page_written(feed, fname) runs once a page is on disk and in the feed
         self._maxitems = maxitems
-        self._items = 0
+        self._on_page_written = on_page_written
+        self._layout = layout if layout != None else PAGE_LAYOUT
         self._title = title
         self._description = description
         self._docroot = docroot
         self._urlroot = urlroot
         self._feed = feed
-        self._fg = FeedGenerator()
         # make sure we have a "/" at the end of the urlroot
         plen = len(self._urlroot)
         if self._urlroot[plen-1:] != "/":
             self._urlroot += "/"
+        self._stylesheet = self._urlroot + STYLESHEET
         # make sure we have a "/" at the end of the docroot
         plen = len(self._docroot)
         if self._docroot[plen-1:] != "/":
             self._docroot += "/"
-        self._fg.id(self._urlroot + self._feed)
-        self._fg.link( href="\"" + self._urlroot + self._feed + "\"")
-        self._fg.description(description)
-        self._fg.title(title)
+        self._manifest = PageManifest(self._docroot + self._feed + ".pages", self._docroot)
+        self._store = FeedStore(self._docroot + self._feed, title,
+                                "\"" + self._urlroot + self._feed + "\"", description, maxitems,
+                                FEED_FLUSH_ITEMS, FEED_FLUSH_INTERVAL,
+                                on_evict = self.evicted if PURGE_ON_EVICT else None)
+        self._templates = {}
+        self._own_pages = pages == None
+        self._pages = PageWriter() if pages == None else pages
         self.reopen_feed()
+        if (PURGE_INTERVAL > 0):
+            self._manifest.start_purging(PURGE_MAX_AGE, PURGE_INTERVAL)
 
     def get_fname(self):
-        dt = datetime.now()
-        ts = time.mktime(dt.timetuple())
-        rn = random.randint(0,10001)
-        return (u'{}'.format(int(ts)) + "_" + str(rn) + ".html")
+        # the page's path relative to the docroot and urlroot, see PAGE_LAYOUT
+        pageid = self._ids.next()
+        when = datetime.fromtimestamp(pageid / 1000000.0, timezone.utc)
+        return when.strftime(self._layout).replace("{id}", "%d-%d" % (pageid, os.getpid()))
 
     def update_feed(self, fname, date, title, description):
-        if (self._items == self._maxitems):
-            # remove the oldest item
-            self._fg.remove_item(self._items - 1)
-            self._items -= 1
-        
-        self._items += 1
-        fe = self._fg.add_entry()
-        fe.id(self._urlroot + fname)
-        fe.title(title)
-        fe.description(description)
-        fe.link(href=self._urlroot + fname)
-        fe.pubDate(date)
-        self._fg.rss_file(self._docroot + self._feed)
+        # the store drops the oldest item once it holds maxitems
+        self._store.add(self._store.render_item(self._urlroot + fname, title, description,
+                                                self._urlroot + fname, date))
+
+    def flush(self):
+        self._store.flush()
+
+    def write_page(self, fname, content, date, title, description, on_durable = None, on_failed = None):
+        # the feed entry is only added once the page it links to is on disk; then
+        # on_durable() runs, if given (on_failed() if the page cannot be written)
+        def written():
+            self.page_written(fname, date, title, description)
+            if (on_durable != None):
+                on_durable()
+        self._pages.write(self._docroot + fname, content, written, on_failed)
+
+    def page_written(self, fname, date, title, description):
+        self._manifest.add(fname)
+        self.update_feed(fname, date, title, description)
+        if (self._on_page_written != None):
+            self._on_page_written(self, fname)
+
+    def feed_path(self):
+        return self._docroot + self._feed
+
+    def evicted(self, guid):
+        # a page that has just dropped out of the feed
+        if (guid.startswith(self._urlroot)):
+            if (self._manifest.remove_page(guid[len(self._urlroot):])):
+                METRICS.inc("pages_evicted")
+
+    def purge(self, max_age = PURGE_MAX_AGE):
+        return self._manifest.purge(max_age)
+
+    def close(self):
+        # a shared page writer is closed by its owner, before the feeds
+        if (self._own_pages):
+            self._pages.close()
+        self._store.close()
         
     def add_item(self, date, headline, body, htmltemplate):
-        try:
-            f = open(htmltemplate, "r")
-            self._template = f.read()
-            f.close()
-        except:
-            self._template = htmltemplate
+        if (htmltemplate not in self._templates):
+            self._templates[htmltemplate] = PageTemplate(htmltemplate)
             
         fname = self.get_fname()
-        f = open(self._docroot + fname, "w")
-        fmt = self._template
-        f.write(fmt.format(headline, 
-                           date.strftime("%Y-%m-%d %H:%M:%S"), 
-                           body))
-        f.close()
-        self.update_feed(fname, date, headline, body)
+        page = self._templates[htmltemplate].render(headline, 
+                                                    date.strftime("%Y-%m-%d %H:%M:%S"), 
+                                                    body,
+                                                    css = self._stylesheet)
+        self.write_page(fname, page, date, headline, body)
        
     def reopen_feed(self):
+        if (self._store.load_state()):
+            return
+        # no sidecar yet (first run after an upgrade): rebuild from the published xml
         d = feedparser.parse(self._docroot + self._feed)
         n = min(self._maxitems,len(d.entries))
-        for i in reversed(range(n)):
-            fe = self._fg.add_entry()
-            fe.id(d.entries[i].guid)
-            fe.title(d.entries[i].title)
-            fe.description(d.entries[i].description)
-            fe.link(href=d.entries[i].link)
-            fe.pubDate(d.entries[i].published)
-            self._items += 1
+        for i in range(n):
+            self._store.append(self._store.render_item(d.entries[i].guid,
+                                                       d.entries[i].title,
+                                                       d.entries[i].description,
+                                                       d.entries[i].link,
+                                                       d.entries[i].published))
+        # also replaces a sidecar that could not be read
+        self._store.save_state()
 
 
 class ChineseRSSFeed(myRSSFeed):
     def __init__(self, en_only_t, cn_only_t, enh_cnb_t, cnh_enb_t, 
-                 feed, title, description, urlroot, docroot = "./rss", maxitems = 100):
-        myRSSFeed.__init__(self,feed, title, description, urlroot, docroot, maxitems)
-        try:
-            f = open(en_only_t, "r")
-            self._en_only_template = f.read()
-            f.close()
-        except:
-            self._en_only_template = en_only_t
+                 feed, title, description, urlroot, docroot = "./rss", maxitems = 100, layout = None,
+                 pages = None, english_only = False, on_page_written = None):
+        myRSSFeed.__init__(self,feed, title, description, urlroot, docroot, maxitems, layout, pages,
+                           on_page_written)
+        self._english_only = english_only
+        self._en_only_template = PageTemplate(en_only_t)
+        self._cn_only_template = PageTemplate(cn_only_t)
+        self._enh_cnb_template = PageTemplate(enh_cnb_t)
+        self._cnh_enb_template = PageTemplate(cnh_enb_t)
 
-        try:
-            f = open(cn_only_t, "r")
-            self._cn_only_template = f.read()
-            f.close()
-        except:
-            self._cn_only_template = cn_only_t
+    def layout(self, story):
+        # (template, template arguments, feed title, feed description) for a story: the
+        # template that matches which of its parts are translated, or always the
+        # English-only one with the English where there is any for an english_only feed
+        date = story.storydate.strftime("%Y-%m-%d %H:%M:%S")
+        if (self._english_only):
+            headline = story.en_headline if story.headline_is_translated else story.headline
+            text = story.en_text if story.body_is_translated else story.text
+            return (self._en_only_template, (headline, date, text), headline, text)
+        elif (story.headline_is_translated and story.body_is_translated):
+            return (self._cn_only_template, (story.headline, story.en_headline, date, story.text, story.en_text),
+                    story.en_headline, story.en_text)
+        elif (story.headline_is_translated and not story.body_is_translated):
+            return (self._cnh_enb_template, (story.headline, story.en_headline, date, story.text),
+                    story.en_headline, story.text)
+        elif (not story.headline_is_translated and story.body_is_translated):
+            return (self._enh_cnb_template, (story.headline, date, story.text, story.en_text),
+                    story.headline, story.en_text)
+        else:
+            return (self._en_only_template, (story.headline, date, story.text),
+                    story.headline, story.text)
 
-        try:
-            f = open(enh_cnb_t, "r")
-            self._enh_cnb_template = f.read()
-            f.close()
-        except:
-            self._enh_cnb_template = enh_cnb_t
+    def add_story(self, story, pages = None, on_durable = None, on_failed = None):
+        # pages holds the story already rendered, by (template text, arguments,
+        # stylesheet), for another feed with the same layout; what is rendered here is
+        # added to it
+        template, args, title, description = self.layout(story)
+        key = (template.text(), args, self._stylesheet)
+        page = None
+        if (pages != None):
+            page = pages.get(key)
+        if (page == None):
+            page = template.render(*args, css = self._stylesheet)
+            if (pages != None):
+                pages[key] = page
+        self.write_page(self.get_fname(), page, story.storydate, title, description, on_durable, on_failed)
 
-        try:
-            f = open(cnh_enb_t, "r")
-            self._cnh_enb_template = f.read()
-            f.close()
-        except:
-            self._cnh_enb_template = cnh_enb_t
 
-    def add_en_only_item(self, date, en_headline, en_body):
-        fname = self.get_fname()
-        f = open(self._docroot + fname, "w")
-        fmt = self._en_only_template
-        f.write(fmt.format(en_headline, 
-                           date.strftime("%Y-%m-%d %H:%M:%S"), 
-                           en_body))
-        f.close()
-        self.update_feed(fname, date, en_headline, en_body)
-    
-    def add_cn_only_item(self, date, cn_headline, en_headline, cn_body, en_body):
-        fname = self.get_fname()
-        f = open(self._docroot + fname, "w")
-        fmt = self._cn_only_template
-        f.write(fmt.format(cn_headline, 
-                           en_headline, 
-                           date.strftime("%Y-%m-%d %H:%M:%S"), 
-                           cn_body, 
-                           en_body))
-        f.close()
-        self.update_feed(fname, date, en_headline, en_body)
-        
-    def add_enh_cnb_item(self, date, en_headline, cn_body, en_body):
-        fname = self.get_fname()
-        f = open(self._docroot + fname, "w")
-        fmt = self._enh_cnb_template
-        f.write(fmt.format(en_headline, 
-                           date.strftime("%Y-%m-%d %H:%M:%S"), 
-                           cn_body, 
-                           en_body))
-        f.close()
-        self.update_feed(fname, date, en_headline, en_body)
-        
-    def add_cnh_enb_item(self, date, cn_headline, en_headline, en_body):
-        fname = self.get_fname()
-        f = open(self._docroot + fname, "w")
-        fmt = self._cnh_enb_template
-        f.write(fmt.format(cn_headline,
-                           en_headline, 
-                           date.strftime("%Y-%m-%d %H:%M:%S"), 
-                           en_body))
-        f.close()
-        self.update_feed(fname, date, en_headline, en_body)
-        
-        
 ########################################################################################
 # XinuaTranslatorRSS: 
 # Get data from UCDP's REST streamer, translate if needed, make into RSS feed
@@ -425,14 +2669,25 @@ class XinhuaTranslatorRSS(Translator):
                  UCDP_ip, 
                  UCDP_cert, 
                  UCDP_certpasswd, 
-                 verbose):
-        Translator.__init__(self, 
-                            UCDP_hostname, 
-                            UCDP_port, 
-                            UCDP_ip, 
-                            UCDP_cert, 
-                            UCDP_certpasswd, 
-                            verbose);
+                 verbose,
+                 workers = PIPELINE_WORKERS,
+                 queuesize = PIPELINE_QUEUESIZE,
+                 backpressure = PIPELINE_BACKPRESSURE,
+                 spooldir = PIPELINE_SPOOLDIR,
+                 processes = PROCESS_WORKERS,
+                 backend = None,
+                 persistent_dedup = True,
+                 on_commit = None,
+                 on_page_written = None):
+        # the feed must exist before the pipeline threads can commit to it; every
+        # output feed shares one page writer.  on_commit(story, outputs) is called with
+        # each committed story and the outputs that want it, and returns the outputs to
+        # publish it to; on_page_written is passed to every output feed
+        self._on_commit = on_commit
+        self._on_page_written = on_page_written
+        self._pages = PageWriter()
+        self._urlroot = rssurlroot
+        self._docroot = rssdocroot
         self._rss = ChineseRSSFeed(EN_ONLY_T, 
                                    CN_ONLY_T, 
                                    ENH_CNB_T, 
@@ -442,37 +2697,152 @@ class XinhuaTranslatorRSS(Translator):
                                    rssdescription, 
                                    rssurlroot,
                                    rssdocroot,
-                                   rssmaxitems)
+                                   rssmaxitems,
+                                   pages = self._pages,
+                                   on_page_written = on_page_written)
+        self._outputs = [ (self._rss, None) ]
+        Translator.__init__(self, 
+                            UCDP_hostname, 
+                            UCDP_port, 
+                            UCDP_ip, 
+                            UCDP_cert, 
+                            UCDP_certpasswd, 
+                            verbose,
+                            workers,
+                            queuesize,
+                            backpressure,
+                            spooldir,
+                            processes,
+                            backend,
+                            persistent_dedup);
         
-    def write(self, data):
-        Translator.write(self, data)
-        if (not self._isTick and self._success):
-            if (self.headline_is_translated and self.body_is_translated):
-                self._rss.add_cn_only_item(self.storydate, self.headline, self.en_headline, self.text, self.en_text)
-            elif (self.headline_is_translated and not self.body_is_translated):
-                self._rss.add_cnh_enb_item(self.storydate, self.headline, self.en_headline, self.text)
-            elif (not self.headline_is_translated and self.body_is_translated):
-                self._rss.add_enh_cnb_item(self.storydate, self.headline, self.text, self.en_text)
-            else:
-                self._rss.add_en_only_item(self.storydate, self.headline, self.text)
-            Translator.clear(self)
-            UCDPData.clear(self)
+    def add_output(self, feed, title, description, urlroot = None, docroot = None, maxitems = 100,
+                   templates = None, predicate = None, english_only = False):
+        # another feed for the same stories; predicate(story) picks the stories for it,
+        # None for all of them
+        if (templates == None):
+            templates = (EN_ONLY_T, CN_ONLY_T, ENH_CNB_T, CNH_ENB_T)
+        output = ChineseRSSFeed(templates[0], templates[1], templates[2], templates[3],
+                                feed, title, description,
+                                urlroot if urlroot != None else self._urlroot,
+                                docroot if docroot != None else self._docroot,
+                                maxitems, pages = self._pages, english_only = english_only,
+                                on_page_written = self._on_page_written)
+        self._outputs.append((output, predicate))
+        return output
+
+    def outputs(self):
+        return [ output for output, predicate in self._outputs ]
+
+    def outputs_for(self, story):
+        return [ output for output, predicate in self._outputs if predicate == None or predicate(story) ]
+
+    def flush(self, then = None):
+        # write out every feed with no page committed in between, then call then()
+        # before the next one can be (e.g. to note how far the feeds have got)
+        with self._pages.paused():
+            for output in self.outputs():
+                output.flush()
+            if (then != None):
+                then()
+
+    def on_story(self, story):
+        outputs = None
+        if (self._on_commit != None):
+            wanted = []
+            if (not story.is_tick and story.success):
+                wanted = self.outputs_for(story)
+            outputs = self._on_commit(story, wanted)
+        self.publish(story, outputs)
+
+    def close_outputs(self):
+        self._pages.close()
+        for output, predicate in self._outputs:
+            output.close()
+
+    def publish(self, story, outputs = None):
+        # to every output that wants it (or just to outputs), rendering each distinct
+        # page once; the story's dedup keys are recorded when the last of its pages
+        # is on disk
+        if (not story.is_tick and story.success):
+            pages = {}
+            if (outputs == None):
+                outputs = self.outputs_for(story)
+            if (len(outputs) == 0):
+                self.remember(story)
+            # [pages still to write, keys]; the keys go once the story has failed
+            state = [ len(outputs), story.dedup_keys ]
+            story.dedup_keys = None
+            def written():
+                # page callbacks run one at a time
+                state[0] -= 1
+                if (state[0] == 0 and state[1] != None):
+                    self._dedup.add(state[1])
+            def failed():
+                # a replay should try the story again, not be dropped as in flight
+                if (state[1] != None):
+                    self._dedup.release(state[1])
+                    state[1] = None
+            try:
+                for output in outputs:
+                    output.add_story(story, pages, written, failed)
+            except Exception:
+                failed()    # the pages already queued cannot complete the count
+                raise
     
     
 def main():
+    # ga_translate.py [--replay SEGMENT|DIR ... --docroot DIR --feed NAME [--speed X]] replays
+    # a capture into a feed of its own instead of connecting
+    parser = argparse.ArgumentParser(description = "Translate the Xinhua feed from UCDP into RSS")
+    parser.add_argument("--replay", nargs = "+", metavar = "CAPTURE", help = "capture segments or directories to replay")
+    parser.add_argument("--speed", type = float, default = 0, help = "replay at this multiple of the captured pace, 0 for as fast as possible")
+    parser.add_argument("--docroot", help = "where a replay writes its pages and feed, required with --replay")
+    parser.add_argument("--feed", help = "feed file name for a replay, required with --replay")
+    args = parser.parse_args()
+
+    docroot = DOCROOT
+    feed = RSSFEEDFILENAME
+    if (args.replay != None):
+        # never into the live feed: the ingester would be rewriting it at the same time
+        if (args.docroot == None or args.feed == None):
+            parser.error("--replay needs --docroot and --feed")
+        if (os.path.realpath(args.docroot) == os.path.realpath(DOCROOT)):
+            parser.error("--replay cannot write into the live docroot " + DOCROOT)
+        docroot = args.docroot
+        feed = args.feed
+    elif (args.docroot != None or args.feed != None):
+        parser.error("--docroot and --feed are only for --replay")
+
+    if (METRICS_PORT != None):
+        METRICS.serve(METRICS_PORT)
+    if (METRICS_LOG_INTERVAL > 0):
+        METRICS.start_log(METRICS_LOG_INTERVAL)
+    # the replayed stories have mostly been published already, the persistent dedup
+    # index would drop them all; repeats within the capture are still dropped
     rss_generator = XinhuaTranslatorRSS(  
-                     rssfeedfilename = RSSFEEDFILENAME, 
+                     rssfeedfilename = feed, 
                      rsstitle        = RSSTITLE, 
                      rssdescription  = RSSDESCRIPTION, 
                      rssurlroot      = URLROOT, 
-                     rssdocroot      = DOCROOT, 
+                     rssdocroot      = docroot, 
                      rssmaxitems     = 100, 
                      UCDP_hostname   = UCDP_hostname, 
                      UCDP_port       = UCDP_port, 
                      UCDP_ip         = UCDP_ip, 
                      UCDP_cert       = UCDP_cert, 
                      UCDP_certpasswd = UCDP_certpasswd, 
-                     verbose         = VERBOSE)
+                     verbose         = VERBOSE,
+                     persistent_dedup = args.replay == None)
+    for output in RSS_OUTPUTS:
+        if (args.replay != None):
+            output = dict(output, docroot = docroot)
+        rss_generator.add_output(**output)
+    if (args.replay != None):
+        rss_generator.replay(args.replay, args.speed)
+        return
+    for sub in UCDP_SUBSCRIPTIONS:
+        rss_generator.add_subscription(**sub)
     rss_generator.run()
 
 if __name__ == "__main__":
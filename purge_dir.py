@@ -2,14 +2,50 @@
 
 import os
 import time
+import argparse
 
 DAYS_to_keep = 5
 PATH="/var/www/html/rss/"
+MANIFEST="xtest.xml.pages"
 
-time_to_keep = DAYS_to_keep * 24 * 3600
-dirents = os.listdir(PATH)
-for ent in dirents:
-    if (time.time() - os.path.getmtime(PATH + ent) > time_to_keep):
-        if (os.path.isfile(PATH + ent)):
-            os.remove(PATH + ent)
-            
\ No newline at end of file
+def scan(path, time_to_keep):
+    # the old way: look at every file in the directory
+    # (including the YYYY/MM/DD/HH shards of the sharded page layout)
+    removed = 0
+    dirents = os.listdir(path)
+    for ent in dirents:
+        if (os.path.isdir(path + ent)):
+            removed += scan(path + ent + "/", time_to_keep)
+            try:
+                os.rmdir(path + ent)
+            except OSError:
+                pass
+        elif (time.time() - os.path.getmtime(path + ent) > time_to_keep):
+            if (os.path.isfile(path + ent)):
+                os.remove(path + ent)
+                removed += 1
+    return removed
+
+def main():
+    parser = argparse.ArgumentParser(description = "Remove old story pages")
+    parser.add_argument("--days", type = float, default = DAYS_to_keep, help = "days to keep a page")
+    parser.add_argument("--path", default = PATH, help = "the docroot holding the pages")
+    parser.add_argument("--manifest", default = MANIFEST, help = "page manifest written by ga_translate, relative to --path")
+    parser.add_argument("--scan", action = "store_true", help = "scan the whole directory instead of using the manifest")
+    args = parser.parse_args()
+
+    path = args.path
+    if (path[-1:] != "/"):
+        path += "/"
+    time_to_keep = args.days * 24 * 3600
+    manifest = os.path.join(path, args.manifest)
+    if (not args.scan and os.path.exists(manifest)):
+        # only the expired prefix of the manifest is read
+        from ga_translate import PageManifest
+        removed = PageManifest(manifest, path).purge(time_to_keep)
+    else:
+        removed = scan(path, time_to_keep)
+    print("Removed %d pages" % removed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ga_translate import CaptureLog, CaptureReader
+
+
+MESSAGES = [ (1532167200.0 + n, (u'{"headline" : "俄美外长通电话 %d"}' % n).encode("UTF-8")) for n in range(50) ]
+
+
+class CaptureRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, True)
+
+    def capture(self, compression, segment_bytes = 1 << 20, buffer = 1 << 20):
+        log = CaptureLog(self.dir, segment_bytes = segment_bytes, compression = compression,
+                         buffer = buffer, flush_interval = 60)
+        for when, msg in MESSAGES:
+            log.append(msg, when)
+        log.close()
+        return CaptureReader([ self.dir ])
+
+    def test_plain_and_zlib(self):
+        for compression in ("none", "zlib"):
+            reader = self.capture(compression)
+            self.assertEqual(len(reader.segments), 1)
+            self.assertEqual([ (when, bytes(msg)) for when, msg in reader.messages() ], MESSAGES)
+            os.remove(reader.segments[0])
+
+    def test_segments_are_rotated_and_read_in_order(self):
+        for compression in ("none", "zlib"):
+            reader = self.capture(compression, segment_bytes = 500, buffer = 1)
+            self.assertGreater(len(reader.segments), 1)
+            self.assertEqual([ (when, bytes(msg)) for when, msg in reader.messages() ], MESSAGES)
+            for segment in reader.segments:
+                os.remove(segment)
+
+    def test_torn_record_ends_the_segment(self):
+        reader = self.capture("none")
+        with open(reader.segments[0], "r+b") as f:
+            f.truncate(os.path.getsize(reader.segments[0]) - 3)
+        self.assertEqual([ (when, bytes(msg)) for when, msg in reader.messages() ], MESSAGES[:-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import ga_translate
+from ga_translate import DedupIndex
+
+
+RSF = (u'<?xml version="1.0" encoding="UTF-8"?>'
+       u'<newsMessage xmlns="http://iptc.org/std/nar/2006-10-01/"><itemSet>'
+       u'<newsItem guid="urn:newsml:xinhua:20180721:1"><contentSet>'
+       u'<inlineData contenttype="text/plain" xml:lang="zh">俄罗斯外长与美国国务卿通电话。</inlineData>'
+       u'</contentSet></newsItem></itemSet></newsMessage>')
+
+
+class DedupIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "dedup.idx")
+        self.addCleanup(shutil.rmtree, self.dir, True)
+
+    def test_reserved_keys_are_duplicates_until_released(self):
+        index = DedupIndex()
+        self.assertFalse(index.check([ "a", "b" ]))
+        self.assertTrue(index.check([ "b" ]))
+        index.release([ "a", "b" ])
+        self.assertFalse(index.check([ "a" ]))
+
+    def test_only_added_keys_persist(self):
+        index = DedupIndex(self.path)
+        index.check([ "a" ])
+        index.check([ "b" ])
+        index.add([ "a" ])
+        index.close()
+        index = DedupIndex(self.path)
+        self.assertTrue(index.check([ "a" ]))
+        self.assertFalse(index.check([ "b" ]))
+        index.close()
+
+    def test_torn_digest_is_cut_off(self):
+        index = DedupIndex(self.path)
+        index.add([ "a", "b" ])
+        index.close()
+        with open(self.path, "ab") as f:
+            f.write(b"xyz")
+        index = DedupIndex(self.path)
+        index.add([ "c" ])
+        index.close()
+        index = DedupIndex(self.path)
+        self.assertTrue(index.check([ "a" ]))
+        self.assertTrue(index.check([ "c" ]))
+        index.close()
+
+    def test_compaction_keeps_the_live_keys(self):
+        index = DedupIndex(self.path, capacity = 4)
+        for n in range(20):
+            index.add([ "k%d" % n ])
+        index.close()
+        self.assertLessEqual(os.path.getsize(self.path), 2 * 4 * DedupIndex._SIZE)
+        index = DedupIndex(self.path, capacity = 4)
+        self.assertTrue(index.check([ "k19" ]))
+        self.assertFalse(index.check([ "k0" ]))
+        index.close()
+
+
+class PublishFailureTest(unittest.TestCase):
+    def setUp(self):
+        self.docroot = tempfile.mkdtemp()
+        patches = mock.patch.multiple(ga_translate, DEDUP_INDEX = None, TRANSLATE_CACHE_DB = None,
+                                      PURGE_INTERVAL = 0, TRANSLATE_RATE = 0, TRANSLATE_CHAR_RATE = 0)
+        patches.start()
+        self.addCleanup(patches.stop)
+        self.addCleanup(shutil.rmtree, self.docroot, True)
+        self.rss = ga_translate.XinhuaTranslatorRSS("main.xml", "t", "d", "http://localhost/rss", self.docroot, 100,
+                                                    "localhost", 8301, "127.0.0.1", "", "", False,
+                                                    workers = 0, backend = ga_translate.StubBackend())
+        self.addCleanup(self.rss.finish)
+
+    def message(self, storydate = "2018-07-21 10:00:00.000"):
+        js = { 'data' : RSF,
+               'language' : "zh", 'headline' : u"俄美外长通电话" }
+        if (storydate != None):
+            js['storydate'] = storydate
+        return json.dumps(js).encode("UTF-8")
+
+    def test_failed_commit_releases_the_story(self):
+        msg = self.message(storydate = None)
+        with self.assertRaises(AttributeError):
+            self.rss.publish(self.rss.process_message(msg))
+        self.assertFalse(self.rss.process_message(msg).duplicate)
+
+    def test_failed_page_write_releases_the_story(self):
+        msg = self.message()
+        with mock.patch.object(ga_translate.PageWriter, "_write", side_effect = OSError("disk full")):
+            self.rss.publish(self.rss.process_message(msg))
+            self.rss._pages.close()
+        self.assertFalse(self.rss.process_message(msg).duplicate)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+from unittest import mock
+
+import ga_translate
+from ga_translate import ScriptDetector, Story
+
+
+class ScriptDetectorTest(unittest.TestCase):
+    def setUp(self):
+        self.detector = ScriptDetector(0.9)
+
+    def test_scripts(self):
+        self.assertEqual(self.detector.detect(u"Lavrov and Pompeo speak by phone"), "en")
+        self.assertEqual(self.detector.detect(u"俄美外长通电话"), "zh")
+        self.assertEqual(self.detector.detect(u"トランプ大統領は日本を訪問した"), "ja")
+        self.assertEqual(self.detector.detect(u"안녕하세요"), "ko")
+        self.assertEqual(self.detector.detect(u"２０１８。"), "")
+
+    def test_middle_dot_is_not_kana(self):
+        self.assertEqual(self.detector.detect(u"俄罗斯总统普京・弗拉基米尔表示"), "zh")
+
+    def test_other_scripts_are_not_guessed(self):
+        self.assertEqual(self.detector.detect(u"Путин встретился с Си Цзиньпином"), None)
+        self.assertEqual(self.detector.detect(u"Putin met Xi, Путин встретился"), None)
+
+
+class TranslateStoryTest(unittest.TestCase):
+    def setUp(self):
+        patches = mock.patch.multiple(ga_translate, DEDUP_INDEX = None, TRANSLATE_CACHE_DB = None,
+                                      TRANSLATE_RATE = 0, TRANSLATE_CHAR_RATE = 0, SCRIPT_DETECTION = True)
+        patches.start()
+        self.addCleanup(patches.stop)
+        self.backend = ga_translate.StubBackend()
+        self.translator = ga_translate.Translator("localhost", 8301, "127.0.0.1", "", "", False,
+                                                  workers = 0, backend = self.backend)
+        self.addCleanup(self.translator.finish)
+
+    def translate(self, headline, language):
+        story = Story()
+        story.success = True
+        story.headline = headline
+        story.headline_lang = language
+        return self.translator.translate_story(story)
+
+    def test_russian_is_translated(self):
+        story = self.translate(u"Путин встретился с Си Цзиньпином", "ru")
+        self.assertTrue(story.headline_is_translated)
+        self.assertEqual(story.en_headline, u"[en] Путин встретился с Си Цзиньпином")
+
+    def test_spanish_is_translated(self):
+        story = self.translate(u"El presidente habló con la prensa", "es")
+        self.assertTrue(story.headline_is_translated)
+
+    def test_chinese_is_translated(self):
+        story = self.translate(u"俄美外长通电话", "zh")
+        self.assertEqual(story.en_headline, u"[en] 俄美外长通电话")
+
+    def test_japanese_is_translated(self):
+        story = self.translate(u"トランプ大統領は日本を訪問した", "ja")
+        self.assertTrue(story.headline_is_translated)
+
+    def test_english_labelled_chinese_is_not_sent(self):
+        story = self.translate(u"Lavrov and Pompeo speak by phone", "zh")
+        self.assertFalse(story.headline_is_translated)
+        self.assertEqual(self.backend.calls, 0)
+
+    def test_mixed_text_sends_only_the_chinese(self):
+        story = self.translate(u"The minister spoke. 俄美外长通电话。", "zh")
+        self.assertEqual(story.en_headline, u"The minister spoke. [en] 俄美外长通电话。")
+        self.assertEqual(self.backend.calls, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timezone
+
+from ga_translate import FeedStore
+
+
+class FeedStoreStateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "x.xml")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors = True)
+
+    def store(self):
+        return FeedStore(self.path, "t", "http://localhost/", "d", maxitems = 10,
+                         flush_items = 1, flush_interval = None)
+
+    def item(self, store, n):
+        return store.render_item("guid%d" % n, "title %d" % n, "body %d" % n,
+                                 "http://localhost/%d.html" % n, datetime(2024, 1, 1, tzinfo = timezone.utc))
+
+    def guids(self, store):
+        return [ FeedStore._GUID.search(item).group(1) for item in store._items ]
+
+    def test_torn_record_is_dropped_and_appends_stay_readable(self):
+        store = self.store()
+        for n in range(3):
+            store.add(self.item(store, n))
+        store.close()
+        with open(self.path + ".state", "r+b") as f:
+            f.truncate(os.path.getsize(self.path + ".state") - 5)
+
+        store = self.store()
+        self.assertTrue(store.load_state())
+        self.assertEqual(self.guids(store), [ "guid1", "guid0" ])
+        store.add(self.item(store, 3))
+        store.close()
+
+        store = self.store()
+        self.assertTrue(store.load_state())
+        self.assertEqual(self.guids(store), [ "guid3", "guid1", "guid0" ])
+
+    def test_undecodable_sidecar_is_not_used(self):
+        with open(self.path + ".state", "wb") as f:
+            f.write(FeedStore._MAGIC + FeedStore._LENGTH.pack(2) + b"\xff\xfe")
+        self.assertFalse(self.store().load_state())
+
+
+if __name__ == "__main__":
+    unittest.main()
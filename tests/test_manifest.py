@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ga_translate import PageManifest
+
+
+class PageManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.docroot = tempfile.mkdtemp() + "/"
+        self.addCleanup(shutil.rmtree, self.docroot, True)
+        self.path = self.docroot + "main.xml.pages"
+        self.manifest = PageManifest(self.path, self.docroot)
+
+    def page(self, fname, created):
+        os.makedirs(os.path.dirname(self.docroot + fname), exist_ok = True)
+        with open(self.docroot + fname, "w") as f:
+            f.write("page")
+        self.manifest.add(fname, created)
+
+    def lines(self):
+        with open(self.path) as f:
+            return [ line.split(" ", 1)[1].rstrip("\n") for line in f ]
+
+    def position(self):
+        with open(self.path + ".pos") as f:
+            return int(f.read())
+
+    def test_expired_prefix_is_purged_then_compacted(self):
+        names = [ "2018/07/21/10/%d.html" % n for n in range(4) ] + [ "2018/07/21/11/4.html" ]
+        for n, name in enumerate(names):
+            self.page(name, 1000 + n)
+
+        # the first expired line is less than half the file: only the position moves
+        self.assertEqual(self.manifest.purge(100, now = 1100.5), 1)
+        self.assertEqual(self.lines(), names)
+        self.assertGreater(self.position(), 0)
+        self.assertFalse(os.path.exists(self.docroot + names[0]))
+
+        # a page already gone leaves the manifest too, but is not counted
+        os.remove(self.docroot + names[2])
+        self.assertEqual(self.manifest.purge(100, now = 1103.5), 2)
+        self.assertEqual(self.lines(), names[4:])
+        self.assertEqual(self.position(), 0)
+        self.assertFalse(os.path.exists(self.docroot + "2018/07/21/10"))
+        self.assertTrue(os.path.exists(self.docroot + names[4]))
+
+        self.page("2018/07/21/11/5.html", 1005)
+        self.assertEqual(self.manifest.purge(100, now = 1200), 2)
+        self.assertEqual(self.lines(), [])
+        self.assertFalse(os.path.exists(self.docroot + "2018"))
+
+    def test_missing_manifest_purges_nothing(self):
+        self.assertEqual(self.manifest.purge(100), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import json
+import unittest
+from unittest import mock
+
+import ga_translate
+from ga_translate import Metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def test_take_and_merge(self):
+        worker = Metrics()
+        worker.inc("errors_rsf")
+        worker.observe("rsf_extract", 0.002, 100)
+        taken = worker.take()
+        self.assertEqual(worker.snapshot()[0], {})
+
+        parent = Metrics()
+        parent.inc("errors_rsf")
+        parent.observe("rsf_extract", 0.002, 50)
+        parent.merge(*taken)
+        counters, stages, gauges = parent.snapshot()
+        self.assertEqual(counters["errors_rsf"], 2)
+        self.assertEqual(stages["rsf_extract"][-1], 150)
+        self.assertEqual(sum(stages["rsf_extract"][:len(Metrics.BUCKETS) + 1]), 2)
+
+
+class ProcessPoolMetricsTest(unittest.TestCase):
+    def test_worker_counters_reach_the_parent(self):
+        with mock.patch.multiple(ga_translate, DEDUP_INDEX = None, TRANSLATE_CACHE_DB = None, METRICS = Metrics()):
+            translator = ga_translate.Translator("localhost", 8301, "127.0.0.1", "", "", False,
+                                                 workers = 1, processes = 1, backend = ga_translate.StubBackend())
+            try:
+                translator.parse_message(b"not json")
+                translator.parse_message(json.dumps({ 'data' : "<bad", 'language' : "zh", 'headline' : "x",
+                                                      'storydate' : "2018-07-21 10:00:00.000" }).encode("UTF-8"))
+            finally:
+                translator.finish()
+            counters, stages, gauges = ga_translate.METRICS.snapshot()
+        self.assertEqual(counters.get("errors_json"), 1)
+        self.assertEqual(counters.get("errors_rsf"), 1)
+        self.assertEqual(counters.get("stories"), 1)
+        self.assertIn("rsf_extract", stages)
+
+
+if __name__ == "__main__":
+    unittest.main()
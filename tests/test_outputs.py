@@ -0,0 +1,90 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import ga_translate
+
+
+RSF = (u'<?xml version="1.0" encoding="UTF-8"?>'
+       u'<newsMessage xmlns="http://iptc.org/std/nar/2006-10-01/"><itemSet>'
+       u'<newsItem guid="urn:newsml:xinhua:20180721:1"><contentSet>'
+       u'<inlineData contenttype="text/plain" xml:lang="zh">俄罗斯外长与美国国务卿通电话。</inlineData>'
+       u'</contentSet></newsItem></itemSet></newsMessage>')
+
+
+def message(headline, language = "zh"):
+    return json.dumps({ 'data' : RSF, 'language' : language, 'headline' : headline,
+                        'storydate' : "2018-07-21 10:00:00.000" }).encode("UTF-8")
+
+
+class EnglishOnlyOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.docroot = tempfile.mkdtemp()
+        patches = mock.patch.multiple(ga_translate, DEDUP_INDEX = None, TRANSLATE_CACHE_DB = None,
+                                      PURGE_INTERVAL = 0, TRANSLATE_RATE = 0, TRANSLATE_CHAR_RATE = 0)
+        patches.start()
+        self.addCleanup(patches.stop)
+        self.addCleanup(shutil.rmtree, self.docroot, True)
+        self.rss = ga_translate.XinhuaTranslatorRSS("main.xml", "t", "d", "http://localhost/rss", self.docroot, 100,
+                                                    "localhost", 8301, "127.0.0.1", "", "", False,
+                                                    workers = 0, backend = ga_translate.StubBackend())
+        self.en = self.rss.add_output("en.xml", "English", "d",
+                                      templates = ("EN {0}|{1}|{2}", "CN", "ENH_CNB", "CNH_ENB"),
+                                      english_only = True)
+
+    def pages(self, feed):
+        with open(os.path.join(self.docroot, feed + ".pages")) as f:
+            names = [ line.split(" ", 1)[1].rstrip("\n") for line in f ]
+        contents = []
+        for name in names:
+            with open(os.path.join(self.docroot, name), encoding = "UTF-8") as f:
+                contents.append(f.read())
+        return contents
+
+    def test_translated_story_uses_the_english(self):
+        self.rss.on_message(message(u"俄美外长通电话"))
+        self.rss.finish()
+        self.assertEqual(self.pages("en.xml"),
+                         [ u"EN [en] 俄美外长通电话|2018-07-21 10:00:00|[en] 俄罗斯外长与美国国务卿通电话。" ])
+
+    def test_untranslated_parts_fall_back_to_the_original(self):
+        self.rss.on_message(message(u"Lavrov and Pompeo speak by phone", "en"))
+        self.rss.finish()
+        self.assertEqual(self.pages("en.xml"),
+                         [ u"EN Lavrov and Pompeo speak by phone|2018-07-21 10:00:00|[en] 俄罗斯外长与美国国务卿通电话。" ])
+
+    def test_outputs_sharing_a_template_text_get_their_own_arguments(self):
+        self.rss.add_output("both.xml", "Both", "d",
+                            templates = ("EN_ONLY", "EN {0}|{1}|{2}", "ENH_CNB", "CNH_ENB"))
+        self.rss.on_message(message(u"俄美外长通电话"))
+        self.rss.finish()
+        self.assertEqual(self.pages("en.xml"),
+                         [ u"EN [en] 俄美外长通电话|2018-07-21 10:00:00|[en] 俄罗斯外长与美国国务卿通电话。" ])
+        self.assertEqual(self.pages("both.xml"),
+                         [ u"EN 俄美外长通电话|[en] 俄美外长通电话|2018-07-21 10:00:00" ])
+
+    def test_stylesheet_comes_from_each_outputs_urlroot(self):
+        templates = ("{css} {0}", "{css} {0}", "ENH_CNB", "CNH_ENB")
+        self.rss.add_output("a.xml", "A", "d", urlroot = "http://localhost/rss", templates = templates)
+        self.rss.add_output("b.xml", "B", "d", urlroot = "https://example.org/news/", templates = templates)
+        self.rss.on_message(message(u"俄美外长通电话"))
+        self.rss.finish()
+        self.assertEqual(self.pages("a.xml"), [ u"http://localhost/rss/css/xtest.css 俄美外长通电话" ])
+        self.assertEqual(self.pages("b.xml"), [ u"https://example.org/news/css/xtest.css 俄美外长通电话" ])
+
+    def test_shipped_templates_link_the_stylesheet_under_the_urlroot(self):
+        here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.rss.add_output("shipped.xml", "Shipped", "d",
+                            templates = tuple(os.path.join(here, "html.template." + name)
+                                              for name in ("en_only", "cnh_cnb", "enh_cnb", "cnh_enb")))
+        self.rss.on_message(message(u"俄美外长通电话"))
+        self.rss.finish()
+        page, = self.pages("shipped.xml")
+        self.assertIn(u'href="http://localhost/rss/css/xtest.css"', page)
+
+
+if __name__ == "__main__":
+    unittest.main()
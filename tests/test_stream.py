@@ -0,0 +1,71 @@
+import gzip
+import json
+import unittest
+import zlib
+
+from ga_translate import StreamDecompressor, UCDPFramer
+
+
+MESSAGES = [ json.dumps({ 'headline' : u"俄美外长通电话", 'data' : u'<a b="{x}">\\"}' }).encode("UTF-8"),
+             json.dumps({ 'tick' : 1, 'nested' : { 'a' : [ 1, { 'b' : "}" } ] } }).encode("UTF-8") ]
+
+
+class UCDPFramerTest(unittest.TestCase):
+    def frame(self, chunks):
+        framer = UCDPFramer()
+        messages = []
+        for chunk in chunks:
+            messages += framer.feed(chunk)
+        return framer, messages
+
+    def test_messages_in_one_chunk(self):
+        framer, messages = self.frame([ b"\r\n".join(MESSAGES) + b"\r\n" ])
+        self.assertEqual(messages, MESSAGES)
+        self.assertEqual(framer.pending(), 0)
+
+    def test_any_split_gives_the_same_messages(self):
+        stream = b"\n".join(MESSAGES)
+        for size in (1, 2, 3, 7):
+            framer, messages = self.frame([ stream[i:i + size] for i in range(0, len(stream), size) ])
+            self.assertEqual(messages, MESSAGES)
+
+    def test_escape_split_across_chunks(self):
+        # the backslash ends one chunk and the quote it escapes starts the next
+        framer, messages = self.frame([ b'{"a" : "x\\', b'"}"', b'}{"b" : 1}' ])
+        self.assertEqual(messages, [ b'{"a" : "x\\"}"}', b'{"b" : 1}' ])
+
+    def test_pending_and_segments(self):
+        framer = UCDPFramer()
+        self.assertEqual(framer.feed(b'{"a" : '), [])
+        self.assertEqual(framer.pending(), 7)
+        self.assertEqual(framer.feed(b'"{"'), [])
+        self.assertEqual(framer.feed(b'}'), [ b'{"a" : "{"}' ])
+        self.assertEqual(framer.last_segments, 3)
+        self.assertEqual(framer.pending(), 0)
+
+
+class StreamDecompressorTest(unittest.TestCase):
+    def decompress(self, compression, data, size):
+        d = StreamDecompressor(compression)
+        out = b"".join(d.decompress(data[i:i + size]) for i in range(0, len(data), size))
+        self.assertEqual(d.raw, len(data))
+        self.assertEqual(d.decompressed, len(out))
+        return out
+
+    def test_formats_split_anywhere(self):
+        data = b"\n".join(MESSAGES) * 20
+        raw = zlib.compressobj(wbits = -zlib.MAX_WBITS)
+        for compression, compressed in (("gzip", gzip.compress(data)), ("zlib", zlib.compress(data)),
+                                        ("deflate", raw.compress(data) + raw.flush()),
+                                        ("", gzip.compress(data))):
+            for size in (1, 5, len(compressed)):
+                self.assertEqual(self.decompress(compression, compressed, size), data)
+
+    def test_gzip_members_follow_each_other(self):
+        compressed = b"".join(gzip.compress(message) for message in MESSAGES)
+        self.assertEqual(self.decompress("gzip", compressed, 3), b"".join(MESSAGES))
+        self.assertEqual(self.decompress("gzip", compressed, len(compressed)), b"".join(MESSAGES))
+
+
+if __name__ == "__main__":
+    unittest.main()
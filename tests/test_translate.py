@@ -0,0 +1,104 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+import ga_translate
+from ga_translate import PRIORITY_BODY, PRIORITY_HEADLINE, StubBackend, TranslateScheduler
+
+
+class SplitTextTest(unittest.TestCase):
+    def setUp(self):
+        patches = mock.patch.multiple(ga_translate, DEDUP_INDEX = None, TRANSLATE_CACHE_DB = None,
+                                      TRANSLATE_RATE = 0, TRANSLATE_CHAR_RATE = 0)
+        patches.start()
+        self.addCleanup(patches.stop)
+        self.translator = ga_translate.Translator("localhost", 8301, "127.0.0.1", "", "", False,
+                                                  workers = 0, backend = StubBackend())
+        self.addCleanup(self.translator.finish)
+
+    def split(self, text, limit):
+        chunks = self.translator.split_text(text, limit)
+        self.assertEqual(u"".join(chunks), text)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk.encode("UTF-8")), limit)
+        return chunks
+
+    def test_breaks_after_sentences(self):
+        self.assertEqual(self.split(u"第一句。第二句！第三句？", 25), [ u"第一句。第二句！", u"第三句？" ])
+        self.assertEqual(self.split(u"One. Two. Three.", 10), [ u"One. Two.", u" Three." ])
+        self.assertEqual(self.split(u"第一段\n\n第二段", 12), [ u"第一段\n\n", u"第二段" ])
+
+    def test_long_sentence_is_cut_on_a_character(self):
+        self.assertEqual(self.split(u"俄" * 10, 7), [ u"俄俄" ] * 5)
+
+    def test_short_text_is_one_chunk(self):
+        self.assertEqual(self.split(u"俄美外长通电话。", 5000), [ u"俄美外长通电话。" ])
+        self.assertEqual(self.split(u"", 5000), [])
+
+
+class Throttled(Exception):
+    response = { 'Error' : { 'Code' : "ThrottlingException" } }
+
+
+class ThrottledBackend(StubBackend):
+    def translate_text(self, text, source, target):
+        raise Throttled()
+
+
+class TranslateSchedulerTest(unittest.TestCase):
+    def scheduler(self, backend = None, max_concurrency = 8):
+        return TranslateScheduler(backend or StubBackend(), rate = 0, char_rate = 0, min_concurrency = 1,
+                                  max_concurrency = max_concurrency, latency_target = 60)
+
+    def test_most_urgent_waiting_request_goes_first(self):
+        scheduler = self.scheduler(max_concurrency = 1)
+        held = scheduler.acquire(1, PRIORITY_BODY)
+        order = []
+
+        def request(name, priority):
+            started = scheduler.acquire(1, priority)
+            order.append(name)
+            scheduler.release(started, False)
+
+        threads = []
+        for name, priority in (("body 1", PRIORITY_BODY), ("body 2", PRIORITY_BODY), ("headline", PRIORITY_HEADLINE)):
+            t = threading.Thread(target = request, args = (name, priority))
+            t.start()
+            threads.append(t)
+            # queue them in this order
+            while (len(scheduler._waiting) < len(threads)):
+                time.sleep(0.001)
+        scheduler.release(held, False)
+        for t in threads:
+            t.join(5)
+        self.assertEqual(order, [ "headline", "body 1", "body 2" ])
+
+    def test_limit_is_halved_once_per_round_and_grows_slowly(self):
+        scheduler = self.scheduler()
+        first = scheduler.acquire(1, PRIORITY_BODY)
+        second = scheduler.acquire(1, PRIORITY_BODY)
+        scheduler.release(first, True)
+        self.assertEqual(scheduler._concurrency, 4.0)
+        # already in flight when the limit was cut
+        scheduler.release(second, True)
+        self.assertEqual(scheduler._concurrency, 4.0)
+        scheduler.release(scheduler.acquire(1, PRIORITY_BODY), True)
+        self.assertEqual(scheduler._concurrency, 2.0)
+        scheduler.release(scheduler.acquire(1, PRIORITY_BODY), False)
+        self.assertEqual(scheduler._concurrency, 2.5)
+        for i in range(3):
+            scheduler.release(scheduler.acquire(1, PRIORITY_BODY), True)
+        self.assertEqual(scheduler._concurrency, 1.0)
+
+    def test_throttling_cuts_the_limit(self):
+        scheduler = self.scheduler(ThrottledBackend())
+        with self.assertRaises(Throttled):
+            scheduler.translate(u"俄美外长通电话")
+        self.assertEqual(scheduler._concurrency, 4.0)
+        self.assertEqual(scheduler._inflight, 0)
+        self.assertEqual(self.scheduler().translate(u"俄美外长通电话")['translatedText'], u"[en] 俄美外长通电话")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,6 +5,7 @@ import certifi
 from google.cloud import translate
 import six
 import boto3
+from ga_translate import UCDPFramer, CaptureLog
 
 try:
     # python 3
@@ -67,14 +68,17 @@ def set_Postfields(c, post_data ):
     c.setopt(c.POSTFIELDS, postfields)
 
 class MyData:
+    def __init__(self, directory = "xinhua_capture"):
+        self._framer = UCDPFramer()
+        self._capture = CaptureLog(directory)
+
     def write(self, data):
-        # This is the received data from UCDP
-        f = open("xinhua.txt", "a+")
-        f.seek(0, 2)
-        byte_str = data.decode('UTF-8')
-        f.write("Length=%d\n" % len(byte_str))
-        f.write(byte_str)
-        f.close()
+        # This is the received data from UCDP; record each complete message
+        for msg in self._framer.feed(data):
+            self._capture.append(msg)
+
+    def close(self):
+        self._capture.close()
 
 def main():
     cn_text = """
@@ -100,6 +104,7 @@ def main():
     except:
         print("Stream interrupted")
         c.close()
+    recvr.close()
 
 if __name__ == "__main__":
     main()